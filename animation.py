@@ -0,0 +1,139 @@
+import os
+import re
+import subprocess
+import tempfile
+from distutils.spawn import find_executable
+import cStringIO as StringIO
+
+import PIL
+from PIL import Image
+
+from imaging import fit, union_size
+from metrics import metrics
+from worker import Worker
+
+# Encode MP4 loops with ffmpeg, if installed
+ffmpeg_enabled = find_executable('ffmpeg') is not None
+
+# Older versions (and PIL) silently save only the first frame of a GIF
+pillow_version = getattr(PIL, '__version__', None) or getattr(PIL, 'PILLOW_VERSION', '0')
+gif_enabled = tuple(int(n) for n in re.findall(r'\d+', pillow_version)[:2]) >= (3, 4)
+
+
+def boomerang(frames):
+    """Returns the frames played forth and back (without repeating the ends)"""
+    return frames + frames[-2:0:-1]
+
+def shared_palette(frames, colors=256):
+    """Returns a palette image for all frames, so colors don't flicker
+    from frame to frame. It is computed from a small mosaic of the frames.
+    """
+    thumbs = [ fit(frame.convert('RGB'), (160, 160)) for frame in frames ]
+    size = union_size(*[ thumb.size for thumb in thumbs ])
+    mosaic = Image.new('RGB', (size[0] * len(thumbs), size[1]))
+    for i, thumb in enumerate(thumbs):
+        mosaic.paste(thumb, (i * size[0], 0))
+    return mosaic.quantize(colors)
+
+def encode_gif(frames, frame_time):
+    """Encodes the frames (of equal size) to a looping GIF, returns the data"""
+    if frames[0].mode == 'L':
+        # Grayscale shares its palette anyway
+        frames = [ frame.convert('P') for frame in frames ]
+    else:
+        palette = shared_palette(frames)
+        frames = [ frame.convert('RGB').quantize(palette=palette) for frame in frames ]
+    buff = StringIO.StringIO()
+    frames[0].save(buff, "GIF", save_all=True, append_images=frames[1:],
+                   duration=int(frame_time * 1000), loop=0)
+    return buff.getvalue()
+
+def encode_mp4(frames, frame_time):
+    """Encodes the frames (of equal size) to an H.264 MP4 with ffmpeg,
+    returns the data
+    """
+    # MP4 needs a seekable output
+    fd, filename = tempfile.mkstemp(suffix='.mp4')
+    os.close(fd)
+    try:
+        process = subprocess.Popen(['ffmpeg', '-loglevel', 'error', '-y',
+                                    '-f', 'image2pipe', '-c:v', 'mjpeg',
+                                    '-framerate', str(1.0 / frame_time), '-i', '-',
+                                    # H.264 needs even sizes
+                                    '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2',
+                                    '-c:v', 'libx264', '-pix_fmt', 'yuv420p',
+                                    '-movflags', '+faststart', filename],
+                                   stdin=subprocess.PIPE)
+        try:
+            for frame in frames:
+                frame.convert('RGB').save(process.stdin, "JPEG", quality=90)
+            process.stdin.close()
+        except:
+            process.kill()
+            process.wait()
+            raise
+        if process.wait() != 0:
+            raise IOError("ffmpeg failed with exit code " + str(process.returncode))
+        with open(filename, 'rb') as f:
+            return f.read()
+    finally:
+        os.remove(filename)
+
+
+class AnimationEncoder:
+    """Makes an animated GIF and, with ffmpeg, an MP4 boomerang loop of
+    the shots of each session.
+
+    Encoding runs on low priority threads and works from the decoded slot
+    sized shots. At most max_pending sessions wait for encoding, beyond
+    that new sessions get no animations rather than slowing down the booth.
+    The animations are written by the storage thread (atomically), next to
+    the assembled picture, e.g., pic00012.gif for pic00012.jpg. Hence no
+    one ever sees an incomplete animation.
+    """
+
+    def __init__(self, storage, size, frame_time=0.3, threads=1, max_pending=2,
+                 nice=10, mp4=True):
+        self.storage    = storage
+        self.size       = size
+        self.frame_time = frame_time
+        self.mp4        = mp4 and ffmpeg_enabled
+        self.worker     = Worker('animation', max_pending, threads, nice)
+
+    def submit(self, frames, basename, callback=None):
+        """Queues the animations of the decoded frames as basename.gif (and
+        basename.mp4). Returns the Job, or None if too many are pending.
+
+        The frames must not be modified until the Job is done. The callback
+        is run with the filename of each animation once it is written.
+        """
+        outputs = [ basename + '.gif' ] + ([ basename + '.mp4' ] if self.mp4 else [])
+        job = self.worker.try_submit(self._encode, frames, outputs, callback)
+        if job is None:
+            metrics.count('animations_skipped')
+        return job
+
+    def pending(self):
+        return self.worker.pending()
+
+    def _encode(self, frames, outputs, callback):
+        try:
+            with metrics.timer('animation_frames'):
+                frames = [ fit(frame, self.size) for frame in frames ]
+                # Shots of the same size
+                size = frames[0].size
+                frames = [ frame if frame.size == size else frame.resize(size, Image.BILINEAR)
+                           for frame in frames ]
+                frames = boomerang(frames)
+
+            for filename in outputs:
+                if filename.endswith('.gif'):
+                    with metrics.timer('animation_gif'):
+                        data = encode_gif(frames, self.frame_time)
+                else:
+                    with metrics.timer('animation_mp4'):
+                        data = encode_mp4(frames, self.frame_time)
+                self.storage.write(filename, data, callback=callback)
+        except Exception as e:
+            print('Error: Encoding animations failed (' + str(e) + ')')
+            raise
@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmarks the image processing hot paths without the booth.
+
+Covers decoding shots (decode strategies and resampling filters compared),
+applying the filter presets and the chroma key, assembling the screen
+picture and the print sheet, the preview frame path (JPEG to surface to
+screen) and show_picture / show_message under SDL's dummy video driver.
+Shots are synthetic 12, 18 and 24 megapixel JPEGs, plus the JPEGs in
+--pictures if given.
+
+Each case runs in its own process and reports wall time per call, peak RSS
+and RSS growth per call. If tracemalloc is available (not on Python 2), it
+reports the Python allocations per call (the peak of memory allocated
+during a call, averaged). The objects the garbage collector still tracks
+afterwards are reported per call as well, which detects leaks but says
+nothing about allocations. Results are saved as JSON, so two revisions can
+be compared:
+
+    python benchmark-images.py --output before.json
+"""
+
+import argparse
+import gc
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+from time import time
+import cStringIO as StringIO
+
+# Must be set before pygame is initialized
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import pygame
+from PIL import Image
+
+import chromakey
+import photobooth
+from filters import get_filter, presets as filter_presets
+from gui import GUI_PyGame, image_to_surface
+from imaging import fit, load_scaled, open_draft, union_size
+from layout import Layout
+
+tracemalloc_enabled = False
+
+try:
+    import tracemalloc
+    tracemalloc_enabled = True
+except ImportError:
+    pass
+
+# Synthetic shots as (name, size)
+synthetic_sizes = [ ('12MP', (4272, 2848)), ('18MP', (5184, 3456)), ('24MP', (6000, 4000)) ]
+
+# Resampling filters to compare
+filters = [ ('nearest', Image.NEAREST), ('bilinear', Image.BILINEAR),
+            ('bicubic', Image.BICUBIC), ('antialias', Image.ANTIALIAS) ]
+
+# Size of the camera's preview frames
+preview_size = (640, 424)
+
+# Look of the pictures, as in the photobooth
+look = get_filter(photobooth.filter_preset)
+
+
+#############
+### Setup ###
+#############
+
+def make_jpeg(filename, size):
+    """Writes a camera-like JPEG (noise compresses like real pictures)"""
+    bands = [ Image.effect_noise(size, sigma).point(lambda v, o=offset: min(255, max(0, v + o)))
+              for sigma, offset in ((40, -20), (60, 0), (30, 30)) ]
+    Image.merge('RGB', bands).save(filename, "JPEG", quality=92)
+
+def prepare_sources(directory, pictures):
+    sources = []
+    for name, size in synthetic_sizes:
+        filename = os.path.join(directory, name + '.jpg')
+        make_jpeg(filename, size)
+        sources.append((name, filename))
+    if pictures:
+        for name in sorted(os.listdir(pictures)):
+            if name.lower().endswith(('.jpg', '.jpeg')):
+                sources.append(('sample-' + os.path.splitext(name)[0],
+                                os.path.join(pictures, name)))
+    return sources
+
+def get_layouts():
+    screen = Layout.load(photobooth.screen_layout, look.mode)
+    sheet  = Layout.load(photobooth.print_layout, look.mode)
+    print_size = (photobooth.image_size[1], photobooth.image_size[0])
+    thumb_size = union_size(screen.slot_size(photobooth.display_size),
+                            sheet.slot_size(print_size))
+    return screen, sheet, print_size, thumb_size
+
+def get_display():
+    return GUI_PyGame('Benchmark', photobooth.display_size, headless=True)
+
+
+#############
+### Cases ###
+#############
+
+# Each case takes the source and returns the function to measure
+
+def decode_full(resample):
+    def case(source):
+        thumb_size = get_layouts()[3]
+        def run():
+            img = Image.open(source)
+            img = img.convert(look.input_mode)
+            return fit(img, thumb_size, resample)
+        return run
+    return case
+
+def decode_draft(resample):
+    def case(source):
+        thumb_size = get_layouts()[3]
+        return lambda: load_scaled(source, thumb_size, look.input_mode, resample)
+    return case
+
+def apply_filter(preset, size):
+    def case(source):
+        preset_filter = get_filter(preset)
+        img = load_scaled(source, size, preset_filter.input_mode)
+        return lambda: preset_filter.apply(img)
+    return case
+
+def chroma_key(size, refine):
+    def case(source):
+        # A green screen filling the left half of the shot
+        img = load_scaled(source, size, 'RGB')
+        img.paste((40, 180, 60), (0, 0, img.size[0] // 2, img.size[1]))
+        key = chromakey.ChromaKey(Image.new('RGB', (1600, 1200), (30, 60, 200)))
+        return lambda: key.apply(img, refine)
+    return case
+
+def assemble(which):
+    def case(source):
+        screen, sheet, print_size, thumb_size = get_layouts()
+        layout, size = (screen, photobooth.display_size) if which == 'screen' else (sheet, print_size)
+        images = [ look.apply(load_scaled(source, thumb_size, look.input_mode))
+                   for i in range(4) ]
+        def run():
+            output_image = layout.render(images, size)
+            buff = StringIO.StringIO()
+            output_image.save(buff, "JPEG")
+            return buff.getvalue()
+        return run
+    return case
+
+def preview_buffer(source):
+    img = open_draft(source, preview_size)
+    img = fit(img.convert('RGB'), preview_size)
+    buff = StringIO.StringIO()
+    img.save(buff, "JPEG", quality=75)
+    return buff.getvalue()
+
+def preview_decode(source):
+    """Preview JPEG to mirrored surface, as in Photobooth.decode_preview"""
+    buff = preview_buffer(source)
+    def run():
+        img = open_draft(StringIO.StringIO(buff), preview_size, look.input_mode)
+        return image_to_surface(look.apply(img), flip=True)
+    return run
+
+def preview_frame(source):
+    """Decoded preview frame and countdown to screen, as in _render_preview"""
+    display = get_display()
+    img = look.apply(Image.open(StringIO.StringIO(preview_buffer(source))))
+    frame = image_to_surface(img, flip=True)
+    def run():
+        display.clear()
+        display.show_picture(image=frame, scratch=True)
+        display.show_message("5" + " " * 36)
+        display.apply()
+    return run
+
+def show_picture(source):
+    display = get_display()
+    def run():
+        display.clear()
+        display.show_picture(source)
+        display.apply()
+    return run
+
+def show_message(cached):
+    def case(source):
+        display = get_display()
+        count = [ 0 ]
+        def run():
+            if not cached:
+                count[0] += 1
+            display.clear()
+            display.show_message(u"OMELETT!!!\n\n%d av 4" % count[0])
+            display.apply()
+        return run
+    return case
+
+def get_cases(sources):
+    """Returns all cases as (name, case, source)"""
+    cases = []
+    for source_name, source in sources:
+        for filter_name, resample in filters:
+            cases.append(('decode/full/%s/%s' % (filter_name, source_name), decode_full(resample), source))
+            cases.append(('decode/draft/%s/%s' % (filter_name, source_name), decode_draft(resample), source))
+        cases.append(('assemble/screen/' + source_name, assemble('screen'), source))
+        cases.append(('assemble/print/' + source_name, assemble('print'), source))
+        cases.append(('gui/show_picture/' + source_name, show_picture, source))
+    # Preview frames are small, their source hardly matters
+    source = sources[0][1]
+    cases.append(('preview/decode', preview_decode, source))
+    cases.append(('preview/frame', preview_frame, source))
+    cases.append(('gui/show_message/cached', show_message(True), source))
+    cases.append(('gui/show_message/uncached', show_message(False), source))
+    thumb_size = get_layouts()[3]
+    for preset in sorted(filter_presets):
+        cases.append(('filter/%s/slot' % preset, apply_filter(preset, thumb_size), source))
+        cases.append(('filter/%s/preview' % preset, apply_filter(preset, preview_size), source))
+    if chromakey.numpy_enabled:
+        cases.append(('chroma_key/slot', chroma_key(thumb_size, True), source))
+        cases.append(('chroma_key/preview', chroma_key(preview_size, False), source))
+    return cases
+
+
+###################
+### Measurement ###
+###################
+
+def current_rss():
+    """Returns the resident set size in kB"""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() // 1024
+
+def reset_peak_rss():
+    # Resets the peak RSS (VmHWM) of this process (Linux 4.0 and later)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except IOError:
+        return False
+
+def peak_rss():
+    """Returns the peak resident set size in kB"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def tracked_objects():
+    """Returns the number of objects tracked by the garbage collector, the
+    growth of it over calls points to leaks
+    """
+    gc.collect()
+    return len(gc.get_objects())
+
+def measure(case, source, repeat):
+    run = case(source)
+    # Warm up caches and lazily loaded modules
+    run()
+    objects_before = tracked_objects()
+    exact_peak = reset_peak_rss()
+    rss_before = current_rss()
+    if tracemalloc_enabled:
+        tracemalloc.start()
+
+    times = []
+    allocated = 0
+    for i in range(repeat):
+        if tracemalloc_enabled:
+            # Counts only what is allocated from here on
+            tracemalloc.clear_traces()
+        tic = time()
+        run()
+        times.append(time() - tic)
+        if tracemalloc_enabled:
+            allocated += tracemalloc.get_traced_memory()[1]
+
+    result = { 'min': min(times), 'mean': sum(times) / len(times), 'max': max(times),
+               'repeat': repeat, 'peak_rss_kb': peak_rss(), 'exact_peak': exact_peak,
+               'rss_growth_kb_per_call': float(current_rss() - rss_before) / repeat,
+               'py_alloc_kb_per_call': None }
+    if tracemalloc_enabled:
+        result['py_alloc_kb_per_call'] = allocated / 1024.0 / repeat
+        tracemalloc.stop()
+    result['leaked_objects_per_call'] = float(tracked_objects() - objects_before) / repeat
+    return result
+
+def run_isolated(case, source, repeat):
+    """Measures a case in a child process, so cases can't affect each other"""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # The child must never return into the caller
+        try:
+            os.close(read_fd)
+            try:
+                result = measure(case, source, repeat)
+            except BaseException as e:
+                result = { 'error': repr(e) }
+            os.write(write_fd, json.dumps(result))
+        finally:
+            os._exit(0)
+
+    os.close(write_fd)
+    data = ''
+    while True:
+        chunk = os.read(read_fd, 65536)
+        if not chunk:
+            break
+        data += chunk
+    os.close(read_fd)
+    os.waitpid(pid, 0)
+    try:
+        return json.loads(data)
+    except ValueError:
+        return { 'error': 'Benchmark process died' }
+
+def get_revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the image hot paths")
+    parser.add_argument('--pictures', help="directory of sample JPEGs to include")
+    parser.add_argument('--output', help="JSON file for the results (default: benchmark-<revision>.json)")
+    parser.add_argument('--repeat', type=int, default=5, help="calls per case")
+    parser.add_argument('--only', help="run only cases containing this string")
+    args = parser.parse_args()
+
+    # Layouts are found relative to the photobooth
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    revision = get_revision()
+    output = args.output or 'benchmark-%s.json' % (revision or 'unknown')
+
+    directory = tempfile.mkdtemp(prefix='photobooth-benchmark-')
+    try:
+        sources = prepare_sources(directory, args.pictures)
+        results = {}
+        if not tracemalloc_enabled:
+            print("Note: tracemalloc is not available, Python allocations are not measured "
+                  "('leaked' only detects objects left behind)")
+        print("%-36s %9s %9s %10s %10s %10s %8s" % ("case", "min [s]", "mean [s]", "peak [MB]",
+                                                  "grow [kB]", "alloc [kB]", "leaked"))
+        for name, case, source in get_cases(sources):
+            if args.only and args.only not in name:
+                continue
+            result = run_isolated(case, source, args.repeat)
+            results[name] = result
+            if 'error' in result:
+                print("%-36s %s" % (name, result['error']))
+            else:
+                alloc = result['py_alloc_kb_per_call']
+                print("%-36s %9.4f %9.4f %10.1f %10.1f %10s %8.1f" % (name, result['min'], result['mean'],
+                      result['peak_rss_kb'] / 1024.0, result['rss_growth_kb_per_call'],
+                      '-' if alloc is None else '%.1f' % alloc, result['leaked_objects_per_call']))
+    finally:
+        shutil.rmtree(directory)
+
+    report = { 'revision': revision, 'time': time(),
+               'platform': platform.platform(), 'python': platform.python_version(),
+               'pil': getattr(Image, 'PILLOW_VERSION', getattr(Image, 'VERSION', None)),
+               'pygame': pygame.version.ver, 'display_size': photobooth.display_size,
+               'image_size': photobooth.image_size, 'filter': photobooth.filter_preset,
+               'tracemalloc': tracemalloc_enabled,
+               'results': results }
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print("Results saved to " + output)
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
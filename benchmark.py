@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Runs complete photobooth sessions unattended and reports their timing.
+
+Camera and printer are replaced by fakes, the GUI runs headless (SDL's
+dummy video driver) and the button presses come from a script. Each
+session is a countdown, four shots, the assembly and, for every n-th
+session, printing. Example:
+
+    python benchmark.py --sessions 200 --pictures samples/ --print-every 2
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+from functools import partial
+from time import time
+
+# Must be set before pygame is initialized
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import photobooth
+from camera import Camera_Fake
+from events import Event
+from metrics import metrics
+from printer import Printer_Fake
+
+
+def report(summary):
+    """Formats the phase timings of metrics.summary() as a table"""
+    lines = [ "%-18s %6s %9s %9s %9s" % ("phase", "count", "p50 [s]", "p95 [s]", "max [s]") ]
+    for phase in sorted(summary['phases']):
+        phase_summary = summary['phases'][phase]
+        lines.append("%-18s %6d %9.3f %9.3f %9.3f" % (phase, phase_summary['count'],
+                     phase_summary['p50'], phase_summary['p95'], phase_summary['max']))
+    for name in sorted(summary['counters']):
+        lines.append("%-18s %6d" % (name, summary['counters'][name]))
+    for name in sorted(summary['gauges']):
+        lines.append("%-18s %9.1f" % (name, summary['gauges'][name]))
+    return '\n'.join(lines)
+
+
+def session_script(sessions, print_every):
+    """Button presses for the given number of sessions"""
+    for i in range(sessions):
+        # Take pictures, then print or cancel
+        yield Event(1, ord('c'))
+        if print_every and (i + 1) % print_every == 0:
+            yield Event(1, ord('r'))
+        else:
+            yield Event(1, ord('s'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark complete photobooth sessions")
+    parser.add_argument('--sessions', type=int, default=100, help="number of sessions")
+    parser.add_argument('--pictures', help="directory of JPEGs to replay (default: generated)")
+    parser.add_argument('--output', help="directory for the pictures (default: temporary)")
+    parser.add_argument('--print-every', type=int, default=0, help="print every n-th session")
+    parser.add_argument('--print-time', type=float, default=0, help="seconds per print job")
+    parser.add_argument('--capture-latency', type=float, default=0.5, help="seconds per shot")
+    parser.add_argument('--preview-latency', type=float, default=0.03, help="seconds per preview frame")
+    parser.add_argument('--fail-every', type=int, default=0, help="fail every n-th shot (recoverable)")
+    parser.add_argument('--low-memory', action='store_true',
+                        help="render the print sheet in bands after the screen picture")
+    parser.add_argument('--pose-time-first', type=int, default=photobooth.pose_time_first,
+                        help="countdown before the first shot (negative: without preview)")
+    parser.add_argument('--pose-time', type=int, default=photobooth.pose_time,
+                        help="countdown before the other shots")
+    args = parser.parse_args()
+
+    # Layouts and cached screens are found relative to the photobooth
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    output = args.output or tempfile.mkdtemp(prefix='photobooth-benchmark-')
+
+    # Replace the hardware
+    photobooth.CameraModule = partial(Camera_Fake, directory=args.pictures,
+                                      capture_latency=args.capture_latency,
+                                      preview_latency=args.preview_latency,
+                                      fail_every=args.fail_every)
+    photobooth.PrinterModule = partial(Printer_Fake, print_time=args.print_time)
+    photobooth.btaddr1 = photobooth.btaddr2 = None
+    photobooth.print_basename = os.path.join(output, "prints", "pic")
+    photobooth.metrics_log = os.path.join(output, "metrics.jsonl")
+    photobooth.metrics_port = None
+    photobooth.low_memory = args.low_memory
+
+    booth = photobooth.Photobooth(photobooth.display_size,
+                                  os.path.join(output, "pictures", "pic"),
+                                  photobooth.image_size, args.pose_time_first,
+                                  args.pose_time, photobooth.display_time,
+                                  photobooth.gpio_trigger_channel,
+                                  photobooth.gpio_shutdown_channel,
+                                  photobooth.gpio_lamp_channel, False,
+                                  photobooth.slideshow_display_time)
+    booth.display.set_script(session_script(args.sessions, args.print_every))
+
+    # The script ends with a quit event, which exits the photobooth
+    tic = time()
+    status = 0
+    try:
+        booth.run()
+    except SystemExit as e:
+        status = e.code
+    booth.storage.flush()
+    wall_time = time() - tic
+
+    summary = metrics.summary()
+    sessions = summary['counters'].get('sessions', 0)
+    print("")
+    print(report(summary))
+    print("")
+    print("Sessions:          %d of %d (exit status %s)" % (sessions, args.sessions, status))
+    print("Wall time:         %.1f s" % wall_time)
+    print("Sessions per hour: %.1f" % (sessions * 3600.0 / wall_time))
+
+    if not args.output:
+        shutil.rmtree(output)
+    return 0 if not status else 1
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -1,8 +1,19 @@
 #!/usr/bin/env python
 # Created by br@re-web.eu, 2015
 
+import os
+import re
+import select
+import shlex
+import shutil
 import subprocess
-from time import sleep
+import tempfile
+from time import sleep, time
+import cStringIO as StringIO
+
+from PIL import Image, ImageDraw
+
+from storage import atomic_write
 
 cv_enabled = False
 gphoto2cffi_enabled = False
@@ -32,6 +43,13 @@ if not gphoto2cffi_enabled:
     except ImportError:
         pass
 
+# Command starting an interactive gPhoto 2 session, used if no Python
+# bindings are available (e.g., "python fake-gphoto2.py" for testing)
+gphoto2_shell = "gphoto2 --shell --force-overwrite"
+
+# Prompt printed by the gPhoto 2 shell when it is ready for a command
+gphoto2_prompt = re.compile(r"gphoto2: \{.*\} .*> $")
+
 class CameraException(Exception):
     """Custom exception class to handle camera class errors"""
     def __init__(self, message, recoverable=False):
@@ -39,8 +57,116 @@ class CameraException(Exception):
         self.recoverable = recoverable
 
 
+def gphoto_error(output):
+    """Maps the error output of gPhoto 2 to a CameraException"""
+    if "EOS Capture failed: 2019" in output or "Perhaps no focus" in output:
+        return CameraException("Can't focus!\nMove a little bit!", True)
+    elif "No camera found" in output:
+        return CameraException("No (supported) camera detected!", False)
+    elif "command not found" in output:
+        return CameraException("gPhoto2 not found!", False)
+    else:
+        return CameraException("Unknown error!\n" + '\n'.join(output.split('\n')[1:3]), False)
+
+
+class GPhotoShell:
+    """A long-lived gPhoto 2 shell session.
+
+    Commands are written to one gphoto2 process, so the camera is opened
+    only once instead of for every shot. Output is read as it arrives until
+    the next prompt, errors are detected line by line. If the process dies,
+    hangs or reports an error, it is restarted with the next command.
+    """
+
+    def __init__(self, command=gphoto2_shell, timeout=30):
+        self.command   = shlex.split(command)
+        self.timeout   = timeout
+        self.directory = tempfile.mkdtemp(prefix='photobooth-gphoto2-')
+        self.process   = None
+
+    def start(self):
+        try:
+            self.process = subprocess.Popen(self.command, cwd=self.directory,
+                                            stdin=subprocess.PIPE,
+                                            stdout=subprocess.PIPE,
+                                            stderr=subprocess.STDOUT)
+        except OSError:
+            raise CameraException("gPhoto2 not found!", False)
+        # Wait for the first prompt
+        self._read_response()
+
+    def stop(self):
+        if self.process is not None:
+            try:
+                self.process.stdin.write("exit\n")
+                self.process.stdin.close()
+            except IOError:
+                pass
+            if self.process.poll() is None:
+                self.process.kill()
+            self.process.wait()
+            self.process = None
+
+    def call(self, command):
+        """Runs one command and returns its output lines"""
+        if self.process is None or self.process.poll() is not None:
+            self.stop()
+            self.start()
+        try:
+            self.process.stdin.write(command + "\n")
+            self.process.stdin.flush()
+        except IOError:
+            self.stop()
+            raise CameraException("Lost connection to gPhoto2!", True)
+        lines = self._read_response()
+        errors = [ line for line in lines if "*** Error" in line or "ERROR" in line ]
+        if errors:
+            error = gphoto_error('\n'.join(lines))
+            # Start over with a freshly opened camera, unless it just
+            # couldn't focus
+            if not error.recoverable:
+                self.stop()
+            raise error
+        return lines
+
+    def capture(self, filename):
+        """Captures a picture and moves it to filename"""
+        downloaded = None
+        for line in self.call("capture-image-and-download"):
+            match = re.match(r"Saving file as (.+)$", line)
+            if match:
+                downloaded = os.path.join(self.directory, match.group(1).strip())
+        if downloaded is None or not os.path.exists(downloaded):
+            raise CameraException("Picture was not downloaded!", True)
+        shutil.move(downloaded, filename)
+        return filename
+
+    def _read_response(self):
+        fd = self.process.stdout.fileno()
+        deadline = time() + self.timeout
+        lines = []
+        partial = ""
+        while True:
+            # Lines are complete, the prompt is not terminated by a newline
+            if gphoto2_prompt.search(partial):
+                return lines
+            remaining = deadline - time()
+            ready = remaining > 0 and select.select([fd], [], [], remaining)[0]
+            if not ready:
+                self.stop()
+                raise CameraException("gPhoto2 is not responding!", True)
+            data = os.read(fd, 4096)
+            if not data:
+                self.stop()
+                raise gphoto_error('\n'.join(lines + [partial]) or "gPhoto2 exited")
+            partial += data
+            split = partial.split('\n')
+            lines += [ line.rstrip('\r') for line in split[:-1] ]
+            partial = split[-1]
+
+
 class Camera_cv:
-    def __init__(self, picture_size):
+    def __init__(self, picture_size, keep_warm=0):
         if cv_enabled:
             self.cap = cv.VideoCapture(0)
             self.cap.set(3, picture_size[0])
@@ -49,6 +175,9 @@ class Camera_cv:
     def has_preview(self):
         return True 
 
+    def has_picture_buff(self):
+        return False
+
     def take_preview(self, filename="/tmp/preview.jpg"):
         self.take_picture(filename)
 
@@ -64,11 +193,104 @@ class Camera_cv:
         pass
 
 
+class Camera_Fake:
+    """Camera class replaying JPEGs, e.g., for tests and benchmarks
+
+    Pictures are taken from the JPEGs in directory in turn (or generated,
+    if none are given), previews are scaled down versions of them. Each
+    preview and picture takes the given latency in seconds and every
+    fail_every-th picture fails with a recoverable CameraException, so
+    runs are reproducible.
+    """
+
+    def __init__(self, picture_size, directory=None, preview_latency=0.03,
+                 capture_latency=0.5, fail_every=0, preview_size=(640, 424),
+                 keep_warm=0):
+        self.preview_latency = preview_latency
+        self.capture_latency = capture_latency
+        self.fail_every      = fail_every
+        self.pictures        = []
+        self.previews        = []
+        self.taken           = 0
+        self.preview_count   = 0
+
+        # Load all pictures up front, so replaying them doesn't touch the disk
+        if directory:
+            for name in sorted(os.listdir(directory)):
+                if name.lower().endswith(('.jpg', '.jpeg')):
+                    with open(os.path.join(directory, name), 'rb') as f:
+                        self.pictures.append(f.read())
+        if not self.pictures:
+            self.pictures = [ self._generate(picture_size, i) for i in range(4) ]
+
+        for data in self.pictures:
+            img = Image.open(StringIO.StringIO(data))
+            img.draft('RGB', preview_size)
+            img = img.convert('RGB')
+            img.thumbnail(preview_size, Image.ANTIALIAS)
+            self.previews.append(self._encode(img))
+
+    def _generate(self, size, index):
+        # Some structure, so the JPEG has a realistic size
+        img = Image.new('RGB', size, (40 * index, 90, 200 - 40 * index))
+        draw = ImageDraw.Draw(img)
+        step = max(size) // 16
+        for i in range(0, max(size), step):
+            draw.ellipse((i, i // 2, i + 3 * step, i // 2 + 2 * step),
+                         fill=((i * 7) % 256, (i * 3) % 256, (index * 60) % 256))
+        return self._encode(img)
+
+    def _encode(self, img):
+        buff = StringIO.StringIO()
+        img.save(buff, "JPEG", quality=90)
+        return buff.getvalue()
+
+    def has_preview(self):
+        return True
+
+    def has_picture_buff(self):
+        return True
+
+    def take_preview_buff(self):
+        sleep(self.preview_latency)
+        self.preview_count += 1
+        return self.previews[self.preview_count % len(self.previews)]
+
+    def take_preview(self, filename="/tmp/preview.jpg"):
+        atomic_write(filename, self.take_preview_buff())
+
+    def take_picture_buff(self):
+        sleep(self.capture_latency)
+        self.taken += 1
+        if self.fail_every and self.taken % self.fail_every == 0:
+            raise CameraException("Can't focus!\nMove a little bit!", True)
+        return self.pictures[self.taken % len(self.pictures)]
+
+    def take_picture(self, filename="/tmp/picture.jpg"):
+        atomic_write(filename, self.take_picture_buff())
+        return filename
+
+    def set_idle(self):
+        return 0
+
+
 class Camera_gPhoto:
-    """Camera class providing functionality to take pictures using gPhoto 2"""
+    """Camera class providing functionality to take pictures using gPhoto 2
+
+    The viewfinder (mirror up, live preview) is kept running for keep_warm
+    seconds after the camera was last used, so a session that follows soon
+    doesn't wait for it to spin up again.
+    """
 
-    def __init__(self, picture_size):
+    def __init__(self, picture_size, shell_command=gphoto2_shell, keep_warm=0):
         self.picture_size = picture_size
+        self.keep_warm = keep_warm
+        self.shell = None
+        # Config widgets are looked up once, the viewfinder state is
+        # tracked locally (None if unknown)
+        self.widgets = {}
+        self.viewfinder = None
+        self.last_used = 0
         # Print the capabilities of the connected camera
         try:
             if gphoto2cffi_enabled:
@@ -77,6 +299,8 @@ class Camera_gPhoto:
                 self.cap = gp.camera()
                 print(self.cap.abilities)
             else:
+                # Keep one gPhoto 2 process for all shots
+                self.shell = GPhotoShell(shell_command)
                 print(self.call_gphoto("-a", "/dev/null"))
         except CameraException as e:
             print('Warning: Listing camera capabilities failed (' + e.message + ')')
@@ -91,20 +315,14 @@ class Camera_gPhoto:
             if "ERROR" in output:
                 raise subprocess.CalledProcessError(returncode=0, cmd=cmd, output=output)
         except subprocess.CalledProcessError as e:
-            if "EOS Capture failed: 2019" in e.output or "Perhaps no focus" in e.output:
-                raise CameraException("Can't focus!\nMove a little bit!", True)
-            elif "No camera found" in e.output:
-                raise CameraException("No (supported) camera detected!", False)
-            elif "command not found" in e.output:
-                raise CameraException("gPhoto2 not found!", False)
-            else:
-                raise CameraException("Unknown error!\n" + '\n'.join(e.output.split('\n')[1:3]), False)
+            raise gphoto_error(e.output)
         return output
 
     def has_preview(self):
         return gphoto2cffi_enabled or piggyphoto_enabled
 
     def take_preview(self, filename="/tmp/preview.jpg"):
+        self._used(viewfinder=True)
         if gphoto2cffi_enabled:
             self._save_picture(filename, self.cap.get_preview())
         elif piggyphoto_enabled:
@@ -113,29 +331,74 @@ class Camera_gPhoto:
             raise CameraException("No preview supported!")
 
     def take_preview_buff(self):
+        self._used(viewfinder=True)
         if gphoto2cffi_enabled:
             return self.cap.get_preview()
         else:
             raise CameraException("No preview supported!")
 
+    def has_picture_buff(self):
+        return gphoto2cffi_enabled
+
+    def take_picture_buff(self):
+        """Takes a picture and returns it as JPEG data, without saving it"""
+        self._used()
+        if gphoto2cffi_enabled:
+            return self.cap.capture()
+        else:
+            raise CameraException("Capturing to memory not supported!")
+
     def take_picture(self, filename="/tmp/picture.jpg"):
+        self._used()
         if gphoto2cffi_enabled:
             self._save_picture(filename, self.cap.capture())
         elif piggyphoto_enabled:
             self.cap.capture_image(filename)
+        elif self.shell is not None:
+            self.shell.capture(filename)
         else:
             self.call_gphoto("--capture-image-and-download", filename)
         return filename
 
     def _save_picture(self, filename, data):
-        sleep(0.01)
-        f = open(filename, 'wb')
-        f.write(data)
-        f.close()
+        atomic_write(filename, data)
 
-    def set_idle(self):
+    def _used(self, viewfinder=None):
+        self.last_used = time()
+        if viewfinder is not None:
+            self.viewfinder = viewfinder
+
+    def _get_widget(self, section, name):
+        """Returns a config widget, fetching the config tree only once"""
+        key = (section, name)
+        if key not in self.widgets:
+            self.widgets[key] = self.cap._get_config()[section][name]
+        return self.widgets[key]
+
+    def set_viewfinder(self, enabled):
+        """Switches the viewfinder, unless it is known to be in that state"""
+        if self.viewfinder == enabled:
+            return
         if gphoto2cffi_enabled:
-            self.cap._get_config()['actions']['viewfinder'].set(False)
+            try:
+                self._get_widget('actions', 'viewfinder').set(enabled)
+            except gpExcept:
+                # The handle may be stale, e.g., after a reconnect
+                self.widgets = {}
+                self._get_widget('actions', 'viewfinder').set(enabled)
         elif piggyphoto_enabled:
             # This doesn't work...
-            self.cap.config.main.actions.viewfinder.value = 0
+            self.cap.config.main.actions.viewfinder.value = int(enabled)
+        self.viewfinder = enabled
+
+    def set_idle(self):
+        """Switches the viewfinder off once the keep warm period is over.
+
+        Returns the remaining seconds of that period, i.e., when to call
+        again, or 0 if the camera is idle now.
+        """
+        remaining = self.last_used + self.keep_warm - time()
+        if remaining > 0:
+            return remaining
+        self.set_viewfinder(False)
+        return 0
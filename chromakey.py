@@ -0,0 +1,83 @@
+from PIL import Image, ImageFilter, ImageOps
+
+from imaging import get_cached
+
+numpy_enabled = False
+
+try:
+    import numpy
+    numpy_enabled = True
+except ImportError:
+    pass
+
+
+class ChromaKey:
+    """Replaces a colored screen (e.g., green) behind the guests by a
+    background picture.
+
+    The matte is computed with NumPy from hue, saturation and value: pixels
+    within tolerance degrees of the key hue, saturated and bright enough
+    are background, with a soft edge of softness degrees. The key hue
+    plus or minus both must stay within 60 degrees of the nearest primary
+    (red, green or blue), pixels further off are never keyed. The key color
+    reflected onto the guests (spill) is suppressed by limiting the key
+    channel to the larger of the other two.
+
+    The background is scaled (and cropped) once per picture size. With
+    refine, the matte is shrunk by a pixel and smoothed, which removes
+    fringes at the edges but costs too much for every preview frame, so it
+    is meant for the slot sized shots.
+    """
+
+    def __init__(self, background, hue=120, tolerance=30, softness=15,
+                 min_saturation=0.25, min_value=0.15, spill=1.0):
+        self.background     = background.convert('RGB')
+        self.hue            = hue
+        self.tolerance      = tolerance
+        self.softness       = float(softness)
+        self.min_saturation = min_saturation
+        self.min_value      = min_value * 255
+        self.spill          = spill
+        # Channel that carries the key color (red, green or blue) and the
+        # key hue relative to the hue of that channel
+        self.channel        = int(round(hue / 120.0)) % 3
+        self.offset         = (hue - 120 * self.channel + 180) % 360 - 180
+        self._backgrounds   = {}
+
+    def apply(self, img, refine=False):
+        """Returns img (RGB) with the screen replaced by the background"""
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        # A copy as floats, so spill can be suppressed in place
+        pixels = numpy.array(img, dtype=numpy.float32)
+        alpha = self.matte(pixels)
+        foreground = Image.fromarray(pixels.astype(numpy.uint8), 'RGB')
+        mask = Image.fromarray((alpha * 255).astype(numpy.uint8), 'L')
+        if refine:
+            mask = mask.filter(ImageFilter.MinFilter(3)).filter(ImageFilter.SMOOTH_MORE)
+        return Image.composite(foreground, self._get_background(img.size), mask)
+
+    def matte(self, pixels):
+        """Returns the opacity (0..1) of the foreground for an RGB array and
+        suppresses the spill in it (in place)
+        """
+        key = pixels[..., self.channel]
+        # The following channels in the order of the hue circle
+        after = pixels[..., (self.channel + 1) % 3]
+        before = pixels[..., (self.channel + 2) % 3]
+        others = numpy.maximum(after, before)
+        delta = key - numpy.minimum(after, before)
+
+        # Only pixels with the key channel highest are within 60 degrees of
+        # the key hue, for them the hue (relative to the channel) is simply
+        hue = 60 * (after - before) / numpy.maximum(delta, 1)
+        distance = numpy.abs(hue - self.offset)
+        screen = numpy.clip((self.tolerance + self.softness - distance) / self.softness, 0, 1)
+        screen *= (key >= others) & (delta >= self.min_saturation * key) & (key >= self.min_value)
+
+        key -= self.spill * numpy.maximum(key - others, 0)
+        return 1 - screen
+
+    def _get_background(self, size):
+        return get_cached(self._backgrounds, size,
+                          lambda: ImageOps.fit(self.background, size, Image.ANTIALIAS), 4)
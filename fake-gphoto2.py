@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Stand-in for "gphoto2 --shell" to test the camera without a camera.
+
+Usage: python fake-gphoto2.py [--fail-every N] [--delay SECONDS] [picture.jpg ...]
+
+Captures copy the given pictures in turn (or a generated gray picture)
+to the current directory, printing what gPhoto 2 would print. Every N-th
+capture fails with the error of a camera that can't focus.
+"""
+
+import os
+import shutil
+import sys
+from time import sleep
+
+from PIL import Image
+
+
+def main(args):
+    fail_every = 0
+    delay = 0.0
+    pictures = []
+    while args:
+        arg = args.pop(0)
+        if arg == '--fail-every':
+            fail_every = int(args.pop(0))
+        elif arg == '--delay':
+            delay = float(args.pop(0))
+        elif not arg.startswith('--'):
+            pictures.append(arg)
+
+    count = 0
+    while True:
+        sys.stdout.write("gphoto2: {" + os.getcwd() + "} /> ")
+        sys.stdout.flush()
+        line = sys.stdin.readline()
+        if not line or line.strip() in ('exit', 'quit', 'q'):
+            return 0
+        command = line.strip()
+        if command == 'capture-image-and-download':
+            count += 1
+            sleep(delay)
+            if fail_every and count % fail_every == 0:
+                print("*** Error (-1: 'Unspecified error') ***")
+                print("EOS Capture failed: 2019 (Perhaps no focus?)")
+                continue
+            name = "capt%04d.jpg" % count
+            if pictures:
+                shutil.copy(pictures[count % len(pictures)], name)
+            else:
+                Image.new('RGB', (3000, 2000), (128, 128, 128)).save(name, "JPEG")
+            print("New file is in location /" + name + " on the camera")
+            print("Saving file as " + name)
+            print("Deleting file /" + name + " on the camera")
+        elif command:
+            print("*** Error: Unknown command '" + command + "' ***")
+
+
+if __name__ == "__main__":
+    exit(main(sys.argv[1:]))
@@ -0,0 +1,103 @@
+from PIL import Image, ImageChops
+
+from imaging import get_cached
+
+# Looks for the pictures, given as options for Filter. They can be combined
+# with '+', e.g., 'sepia+vignette', later ones override earlier ones.
+presets = {
+    'color':       { },
+    'bw':          { 'mono': True },
+    'bw-contrast': { 'mono': True, 'contrast': 0.6 },
+    'sepia':       { 'mono': True, 'contrast': 0.3, 'gamma': (0.85, 1.0, 1.3) },
+    'warm':        { 'contrast': 0.2, 'gamma': (0.9, 1.0, 1.15) },
+    'vignette':    { 'vignette': 0.5 },
+}
+
+
+def get_filter(name):
+    """Returns the Filter for a preset name, e.g., 'bw-contrast+vignette'"""
+    options = {}
+    for preset in name.split('+'):
+        if preset not in presets:
+            raise ValueError("Unknown filter preset '" + preset + "'")
+        options.update(presets[preset])
+    return Filter(**options)
+
+
+class Filter:
+    """A look for the pictures: a contrast curve, per channel gamma (to tint)
+    and a vignette.
+
+    All of it is precomputed, the curve and the gammas as one lookup table
+    (a palette for tinted black and white) and the vignette as a mask per
+    picture size. Applying it is a single table lookup plus a multiply by
+    the mask, so it is meant to run on slot sized shots and preview frames,
+    not on originals.
+
+    Pictures should be decoded as input_mode, which is 'L' for black and
+    white. Filtered pictures are of mode.
+    """
+
+    def __init__(self, mono=False, contrast=0.0, gamma=None, vignette=0.0):
+        self.input_mode = 'L' if mono else 'RGB'
+        self.mode       = 'RGB' if gamma or not mono else 'L'
+        self.vignette   = vignette
+        self._masks     = {}
+
+        curve = [ _s_curve(i, contrast) for i in range(256) ]
+        if gamma:
+            tables = [ [ _gamma(v, g) for v in curve ] for g in gamma ]
+        else:
+            tables = [ curve ] * (1 if mono else 3)
+
+        self.palette = None
+        self.table   = None
+        if mono and gamma:
+            # Map gray levels to colors through a palette
+            self.palette = [ c for rgb in zip(*tables) for c in rgb ]
+        elif any(table != range(256) for table in tables):
+            self.table = [ c for table in tables for c in table ]
+
+    def apply(self, img):
+        """Returns img with the filter applied, img is not modified"""
+        if img.mode != self.input_mode:
+            img = img.convert(self.input_mode)
+        if self.palette is not None:
+            img = img.copy()
+            img.putpalette(self.palette)
+            img = img.convert('RGB')
+        elif self.table is not None:
+            img = img.point(self.table)
+        if self.vignette:
+            img = ImageChops.multiply(img, self._get_mask(img.size, img.mode))
+        return img
+
+    def _get_mask(self, size, mode):
+        def create():
+            mask = _vignette_mask(size, self.vignette)
+            return mask if mode == 'L' else mask.convert(mode)
+        return get_cached(self._masks, (size, mode), create)
+
+
+def _s_curve(i, amount):
+    # Blends linear with smoothstep, which steepens the midtones
+    x = i / 255.0
+    y = x + amount * (x * x * (3 - 2 * x) - x)
+    return int(round(255 * y))
+
+def _gamma(v, g):
+    return int(round(255 * (v / 255.0) ** g))
+
+def _vignette_mask(size, strength):
+    """Returns a mask darkening the corners by strength (0..1)"""
+    # Computed small and scaled up, it is smooth anyway
+    w, h = max(2, size[0] // 8), max(2, size[1] // 8)
+    data = []
+    for y in range(h):
+        dy = (2.0 * y / (h - 1) - 1) ** 2
+        for x in range(w):
+            d = min(1.0, ((2.0 * x / (w - 1) - 1) ** 2 + dy) / 2)
+            data.append(int(round(255 * (1 - strength * d * d))))
+    mask = Image.new('L', (w, h))
+    mask.putdata(data)
+    return mask.resize(size, Image.BILINEAR)
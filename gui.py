@@ -3,9 +3,19 @@
 
 from __future__ import division
 
+import hashlib
+import json
+import os
 import pygame
+from collections import OrderedDict
+from threading import Lock
 from time import sleep
 
+from PIL import Image
+
+from imaging import open_draft
+from storage import atomic_write
+
 try:
     import pygame.fastevent as EventModule
 except ImportError:
@@ -16,16 +26,200 @@ from events import Event
 class GuiException(Exception):
     """Custom exception class to handle GUI class errors"""
 
+# Event type used to wake up waiting for events after a timeout
+timeout_event = pygame.USEREVENT + 1
+
+# Memory limit (in bytes) for rendered messages
+text_cache_size = 16 * 1024 * 1024
+
+# Fonts, loaded once per size
+fonts = {}
+
+def get_font(size):
+    if size not in fonts:
+        fonts[size] = pygame.font.Font(None, size)
+    return fonts[size]
+
+# Palette to display 8-bit grayscale surfaces
+grayscale_palette = [ (i, i, i) for i in range(256) ]
+
+def image_to_surface(image, flip=False):
+    """Maps a decoded PIL image to a pygame surface.
+
+    The pixel data is copied once into the buffer that backs the surface.
+    Grayscale images stay grayscale (as 8-bit palette surfaces) instead of
+    being expanded to RGB first. Other modes except RGB(A) need an extra
+    conversion. If flip is set, the image is mirrored horizontally.
+    """
+    if flip:
+        image = image.transpose(Image.FLIP_LEFT_RIGHT)
+    if image.mode == 'L':
+        data = image.tobytes()
+        try:
+            surface = pygame.image.frombuffer(data, image.size, 'P')
+        except ValueError:
+            # Older pygame versions can't wrap palette buffers
+            surface = pygame.image.fromstring(data, image.size, 'P')
+        surface.set_palette(grayscale_palette)
+        return surface
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGB')
+    return pygame.image.frombuffer(image.tobytes(), image.size, image.mode)
+
+class SurfaceCache:
+    """A thread-safe LRU cache of surfaces, bounded by their memory size"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        """Returns the cached surface (and marks it as recently used) or None"""
+        with self._lock:
+            if key not in self._items:
+                return None
+            item = self._items.pop(key)
+            self._items[key] = item
+            return item[0]
+
+    def put(self, key, surface, nbytes=None):
+        """Caches a surface (or any other value if nbytes is given)"""
+        if nbytes is None:
+            nbytes = surface.get_pitch() * surface.get_height()
+        with self._lock:
+            if key in self._items:
+                self.bytes -= self._items.pop(key)[1]
+            self._items[key] = (surface, nbytes)
+            self.bytes += nbytes
+            # Evict least recently used surfaces, but keep the newest one
+            while self.bytes > self.max_bytes and len(self._items) > 1:
+                self.bytes -= self._items.popitem(last=False)[1][1]
+
+
+class ScreenAtlas:
+    """Pre-rendered surfaces for the fixed screens of an application.
+
+    Each screen is a list of (message, color) pairs that are rendered like
+    show_message and composed into one cropped surface. If a directory is
+    given, rendered screens are stored there as PNG files and loaded on
+    later starts, as long as their messages and the display size are
+    unchanged.
+    """
+
+    # Background color made transparent, as in show_message
+    bg = (230, 230, 230)
+
+    def __init__(self, display, screens, directory=None):
+        self.display   = display
+        self.screens   = screens
+        self.directory = directory
+        self.surfaces  = {}
+        self.index     = {}
+        self._deferred = False
+
+        if self.directory:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            try:
+                with open(os.path.join(self.directory, 'index.json')) as f:
+                    self.index = json.load(f)
+            except (IOError, ValueError):
+                self.index = {}
+
+    def prepare(self):
+        """Loads or renders all screens"""
+        self._deferred = True
+        try:
+            for name in self.screens:
+                self.get(name)
+        finally:
+            self._deferred = False
+        self._save_index()
+
+    def get(self, name):
+        """Returns surface and offset of a screen"""
+        if name not in self.surfaces:
+            if name not in self.screens:
+                raise GuiException("Unknown screen: " + str(name))
+            surface = self._load(name)
+            if surface is None:
+                surface = self._render(name)
+                if not self._deferred:
+                    self._save_index()
+            self.surfaces[name] = surface
+        return self.surfaces[name]
+
+    def _key(self, name):
+        spec = (self.screens[name], self.display.get_size(), pygame.version.ver)
+        return hashlib.sha1(repr(spec).encode('utf-8')).hexdigest()
+
+    def _load(self, name):
+        key = self._key(name)
+        if not self.directory or key not in self.index:
+            return None
+        try:
+            surface = pygame.image.load(os.path.join(self.directory, key + '.png')).convert()
+        except pygame.error:
+            return None
+        surface.set_colorkey(self.bg, pygame.RLEACCEL)
+        return surface, tuple(self.index[key])
+
+    def _render(self, name):
+        parts = [ self.display.render_message(msg, color=color, bg=self.bg)
+                  for msg, color in self.screens[name] ]
+        rects = [ pygame.Rect(origin, surface.get_size()) for surface, origin in parts ]
+        rect = rects[0].unionall(rects[1:])
+
+        surface = pygame.Surface(rect.size)
+        surface.fill(self.bg)
+        for part, part_rect in zip(parts, rects):
+            surface.blit(part[0], part_rect.move(-rect.x, -rect.y))
+        surface.set_colorkey(self.bg, pygame.RLEACCEL)
+
+        if self.directory:
+            key = self._key(name)
+            pygame.image.save(surface, os.path.join(self.directory, key + '.png'))
+            self.index[key] = rect.topleft
+        return surface, rect.topleft
+
+    def _save_index(self):
+        if self.directory:
+            atomic_write(os.path.join(self.directory, 'index.json'), json.dumps(self.index))
+
+
 class GUI_PyGame:
     """A GUI class using PyGame"""
 
-    def __init__(self, name, size, hide_mouse=True):
+    # Layers of the frame on screen and the instance that drew them
+    shown = None
+
+    def __init__(self, name, size, hide_mouse=True, headless=None):
+        # Run without a screen if requested or if SDL has been told so
+        if headless is None:
+            headless = os.environ.get('SDL_VIDEODRIVER') == 'dummy'
+        elif headless:
+            os.environ['SDL_VIDEODRIVER'] = 'dummy'
+        self.headless = headless
+
         # Call init routines
         pygame.init()
 
         # Store screen and size
         self.size = size
-        self.screen = pygame.display.set_mode(size, pygame.FULLSCREEN)
+        self.scratch = {}
+        self.text_cache = SurfaceCache(text_cache_size)
+        self.atlas = None
+        self.script = None
+        self.screen = pygame.display.set_mode(size, 0 if headless else pygame.FULLSCREEN)
 
         if hasattr(EventModule, 'init'):
             EventModule.init()
@@ -34,7 +228,7 @@ class GUI_PyGame:
         pygame.display.set_caption(name)
 
         # Hide mouse cursor
-        if hide_mouse:
+        if hide_mouse and not headless:
             pygame.mouse.set_cursor(*pygame.cursors.load_xbm('transparent.xbm','transparent.msk'))
 
         # Clear screen
@@ -42,13 +236,53 @@ class GUI_PyGame:
         self.apply()
 
     def clear(self, color=(0,0,0)):
-        self.screen.fill(color)
+        self.background = color
         self.surface_list = []
 
     def apply(self):
-        for surface in self.surface_list:
-            self.screen.blit(surface[0], surface[1])
-        pygame.display.update()
+        """Draws all layers, but only where they differ from the last frame.
+
+        Layers are compared with the last frame by surface and position, in
+        the order they were added. Layers marked as volatile (e.g., preview
+        frames in a scratch surface) always count as changed. Only the
+        changed rectangles are redrawn and passed to the display.
+        """
+        layers = [ (surface, pygame.Rect(offset, surface.get_size()), volatile)
+                   for surface, offset, volatile in self.surface_list ]
+
+        # The screen is shared by all instances (e.g., the slideshow)
+        shown = GUI_PyGame.shown
+        screen_rect = self.screen.get_rect()
+        if shown is None or shown[0] is not self or shown[1] != self.background:
+            dirty = [ screen_rect ]
+        else:
+            dirty = self._changed_rects(shown[2], layers)
+            if sum(rect.width * rect.height for rect in dirty) >= screen_rect.width * screen_rect.height:
+                dirty = [ screen_rect ]
+
+        for rect in dirty:
+            self.screen.set_clip(rect)
+            self.screen.fill(self.background)
+            for surface, layer_rect, volatile in layers:
+                if layer_rect.colliderect(rect):
+                    self.screen.blit(surface, layer_rect)
+        self.screen.set_clip(None)
+
+        GUI_PyGame.shown = (self, self.background, layers)
+        if dirty:
+            pygame.display.update(dirty)
+
+    def _changed_rects(self, old_layers, new_layers):
+        dirty = []
+        for i in range(max(len(old_layers), len(new_layers))):
+            old = old_layers[i] if i < len(old_layers) else None
+            new = new_layers[i] if i < len(new_layers) else None
+            if old and new and old[0] is new[0] and old[1] == new[1] and not new[2]:
+                continue
+            for layer in (old, new):
+                if layer and layer[1] not in dirty:
+                    dirty.append(layer[1])
+        return dirty
 
     def get_size(self):
         return self.size
@@ -56,44 +290,88 @@ class GUI_PyGame:
     def trigger_event(self, event_channel):
         EventModule.post(EventModule.Event(pygame.USEREVENT, channel=event_channel))
 
-    def show_picture(self, filename="No file", size=(0,0), offset=(0,0), flip=False, image=None):
+    def show_picture(self, filename="No file", size=(0,0), offset=(0,0), flip=False, image=None, scratch=False):
         # Use window size if none given
         if size == (0,0):
             size = self.size
         try:
-            # Load image from file
-            if not image:
-                image = pygame.image.load(filename)
-        except pygame.error as e:
-            raise GuiException("ERROR: Can't open image '" + filename + "': " + e.message)
+            # Load image from file, decoding JPEGs at reduced size
+            if image is None:
+                image = open_draft(filename, size)
+            surface = self.fit_image(image, size, flip, scratch)
+        except (IOError, pygame.error) as e:
+            raise GuiException("ERROR: Can't open image '" + filename + "': " + str(e))
+        # Update offset
+        offset = tuple(a+int((b-c)/2) for a,b,c in zip(offset, size, surface.get_size()))
+        self.surface_list.append((surface, offset, scratch))
+
+    def fit_image(self, image, size=(0,0), flip=False, scratch=False):
+        """Scales a PIL image or pygame surface to fit into size.
+
+        The aspect ratio is kept. Mirroring is done before scaling, i.e.,
+        on the (usually smaller) source. With scratch=True the image is
+        scaled into a reusable surface, which is overwritten by the next
+        scratch image of the same size, e.g., the next preview frame.
+        """
+        # Use window size if none given
+        if size == (0,0):
+            size = self.size
+        if not isinstance(image, pygame.Surface):
+            image = image_to_surface(image, flip)
+        elif flip:
+            image = pygame.transform.flip(image, True, False)
         # Extract image size and determine scaling
-        image_size = image.get_rect().size
+        image_size = image.get_size()
         image_scale = min([min(a,b)/b for a,b in zip(size, image_size)])
         # New image size
-        new_size = [int(a*image_scale) for a in image_size]
-        # Update offset
-        offset = tuple(a+int((b-c)/2) for a,b,c in zip(offset, size, new_size))
-        # Apply scaling and display picture
-        image = pygame.transform.scale(image, new_size).convert()
-        # Create surface and blit the image to it
-        surface = pygame.Surface(new_size)
-        surface.blit(image, (0,0))
-        if flip:
-            surface = pygame.transform.flip(surface, True, False)
-        self.surface_list.append((surface, offset))
-
-    def show_message(self, msg, color=(0,0,0), bg=(230,230,230), transparency=True, outline=(245,245,245)):
-        # Choose font
-        font = pygame.font.Font(None, 144)
-        # Wrap and render text
-        wrapped_text, text_height = self.wrap_text(msg, font, self.size)
-        rendered_text = self.render_text(wrapped_text, text_height, 1, 1, font, color, bg, transparency, outline)
+        new_size = tuple(int(a*image_scale) for a in image_size)
+        if scratch:
+            return pygame.transform.scale(image, new_size, self._scratch_surface(new_size, image))
+        elif new_size == image_size:
+            return image
+        else:
+            return pygame.transform.scale(image, new_size)
+
+    def _scratch_surface(self, size, image):
+        key = (size, image.get_bitsize(), image.get_masks())
+        if key not in self.scratch:
+            self.scratch[key] = pygame.Surface(size, 0, image)
+        surface = self.scratch[key]
+        if image.get_bitsize() == 8:
+            surface.set_palette(image.get_palette())
+        return surface
 
-        self.surface_list.append((rendered_text, (0,0)))
+    def show_message(self, msg, color=(0,0,0), bg=(230,230,230), transparency=True, outline=(245,245,245), font_size=144):
+        rendered_text = self.render_message(msg, color, bg, transparency, outline, font_size)
+        self.surface_list.append(rendered_text + (False,))
+
+    def set_atlas(self, atlas):
+        self.atlas = atlas
+
+    def show_screen(self, name):
+        """Shows a pre-rendered screen of the atlas"""
+        if self.atlas is None:
+            raise GuiException("No screen atlas set")
+        self.surface_list.append(self.atlas.get(name) + (False,))
+
+    def render_message(self, msg, color=(0,0,0), bg=(230,230,230), transparency=True, outline=(245,245,245), font_size=144):
+        """Returns the rendered message and its offset (see render_text)"""
+        # Rendered messages are cached, e.g., for countdown digits
+        key = (msg, color, bg, transparency, outline, font_size)
+        rendered_text = self.text_cache.get(key)
+        if rendered_text is None:
+            # Choose font
+            font = get_font(font_size)
+            # Wrap and render text
+            wrapped_text, text_height = self.wrap_text(msg, font, self.size)
+            rendered_text = self.render_text(wrapped_text, text_height, 1, 1, font, color, bg, transparency, outline)
+            surface = rendered_text[0]
+            self.text_cache.put(key, rendered_text, surface.get_pitch() * surface.get_height())
+        return rendered_text
 
     def show_button(self, text, pos, size=(0,0), color=(230,230,230), bg=(0,0,0), transparency=True, outline=(230,230,230)):
         # Choose font
-        font = pygame.font.Font(None, 72)
+        font = get_font(72)
         text_size = font.size(text)
         if size == (0,0):
             size = (text_size[0] + 4, text_size[1] + 4)
@@ -114,7 +392,7 @@ class GUI_PyGame:
         if transparency:
             surface.set_colorkey(bg)
 
-        self.surface_list.append((surface, (0,0)))
+        self.surface_list.append((surface, (0,0), False))
 
     def wrap_text(self, msg, font, size):
         final_lines = []                   # resulting wrapped text
@@ -167,6 +445,11 @@ class GUI_PyGame:
         return final_lines, accumulated_height
 
     def render_text(self, text, text_height, valign, halign, font, color, bg, transparency, outline):
+        """Renders the lines of text with an outline.
+
+        Returns the surface and its offset on the screen. Transparent
+        text is cropped to the lines it contains.
+        """
         # Determine vertical position
         if valign == 0:     # top aligned
             voffset = 0
@@ -177,24 +460,44 @@ class GUI_PyGame:
         else:
             raise GuiException("Invalid valign argument: " + str(valign))
 
-        # Create Surface object and fill it with the given background
-        surface = pygame.Surface(self.size) 
-        surface.fill(bg) 
-
-        # Blit one line after another
+        # Determine position of one line after another
+        lines = []
         accumulated_height = 0 
         for line in text: 
-            maintext = font.render(line, 1, color)
-            shadow = font.render(line, 1, outline)
+            line_size = font.size(line)
             if halign == 0:     # left aligned
                 hoffset = 0
             elif halign == 1:   # centered
-                hoffset = (self.size[0] - maintext.get_width()) / 2
+                hoffset = int((self.size[0] - line_size[0]) / 2)
             elif halign == 2:   # right aligned
-                hoffset = rect.width - maintext.get_width()
+                hoffset = self.size[0] - line_size[0]
             else:
-                raise GuiException("Invalid halign argument: " + str(justification))
-            pos = (hoffset, voffset + accumulated_height)
+                raise GuiException("Invalid halign argument: " + str(halign))
+            if line:
+                lines.append((line, (hoffset, voffset + accumulated_height), line_size))
+            accumulated_height += line_size[1]
+
+        # Crop to the lines including their outline
+        if not transparency:
+            origin, size = (0, 0), self.size
+        elif not lines:
+            origin, size = (0, 0), (1, 1)
+        else:
+            left   = min(pos[0] for line, pos, line_size in lines) - 1
+            top    = min(pos[1] for line, pos, line_size in lines) - 1
+            right  = max(pos[0] + line_size[0] for line, pos, line_size in lines) + 1
+            bottom = max(pos[1] + line_size[1] for line, pos, line_size in lines) + 1
+            origin, size = (left, top), (right - left, bottom - top)
+
+        # Create Surface object and fill it with the given background
+        surface = pygame.Surface(size) 
+        surface.fill(bg) 
+
+        # Blit one line after another
+        for line, pos, line_size in lines:
+            maintext = font.render(line, 1, color)
+            shadow = font.render(line, 1, outline)
+            pos = (pos[0] - origin[0], pos[1] - origin[1])
             # Outline
             surface.blit(shadow, (pos[0]-1,pos[1]-1))
             surface.blit(shadow, (pos[0]-1,pos[1]+1))
@@ -202,14 +505,13 @@ class GUI_PyGame:
             surface.blit(shadow, (pos[0]+1,pos[1]+1))
             # Text
             surface.blit(maintext, pos)
-            accumulated_height += font.size(line)[1]
 
         # Make background color transparent
         if transparency:
-            surface.set_colorkey(bg)
+            surface.set_colorkey(bg, pygame.RLEACCEL)
 
         # Return the rendered surface
-        return surface
+        return surface, origin
 
     def convert_event(self, event):
         if event.type == pygame.QUIT: 
@@ -218,23 +520,50 @@ class GUI_PyGame:
             return True, Event(1, event.key)
         elif event.type == pygame.MOUSEBUTTONUP: 
             return True, Event(2, (event.button, event.pos))
+        elif event.type == timeout_event:
+            return False, ''
         elif event.type >= pygame.USEREVENT: 
             return True, Event(3, event.channel)
         else:
             return False, ''
 
-    def check_for_event(self):
+    def check_for_event(self, timeout=0):
+        """Returns the next relevant event as (True, event) or (False, '')
+
+        If no event is pending, it waits up to timeout seconds for one
+        (forever if timeout is None) without using the CPU.
+        """
         for event in EventModule.get():
             r, e = self.convert_event(event)
             if r:
                 return r, e
-        return False, ''
+        if timeout is not None and timeout <= 0:
+            return False, ''
+        if self.script is not None:
+            return True, self._next_scripted()
+
+        # Let a timer event end the wait
+        if timeout is not None:
+            pygame.time.set_timer(timeout_event, max(1, int(timeout * 1000)))
+        try:
+            while True:
+                event = EventModule.wait()
+                if event.type == timeout_event:
+                    return False, ''
+                r, e = self.convert_event(event)
+                if r:
+                    return r, e
+        finally:
+            if timeout is not None:
+                pygame.time.set_timer(timeout_event, 0)
 
     def wait_for_event(self):
         # Repeat until a relevant event happened
         while True:
             # Discard all input that happened before entering the loop
             EventModule.get()
+            if self.script is not None:
+                return self._next_scripted()
 
             # Wait for event
             event = EventModule.wait()
@@ -244,6 +573,18 @@ class GUI_PyGame:
             if r:
                 return e
 
+    def set_script(self, events):
+        """Replays the given events, e.g., for benchmarks.
+
+        Whenever nothing is pending and the caller would wait for an event,
+        the next scripted one is returned instead. Once all of them have
+        been used up, a quit event follows.
+        """
+        self.script = iter(events)
+
+    def _next_scripted(self):
+        return next(self.script, Event(0, 0))
+
     def cancel_events(self):
         sleep(0.5)
         for event in EventModule.get():
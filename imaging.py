@@ -0,0 +1,113 @@
+import subprocess
+import tempfile
+from distutils.spawn import find_executable
+import cStringIO as StringIO
+
+from PIL import Image
+
+# Encode JPEGs from a stream of bands with libjpeg's cjpeg, if installed
+cjpeg_enabled = find_executable('cjpeg') is not None
+
+
+def open_draft(source, size, mode=None):
+    """Opens an image for decoding at (at least) the given size.
+
+    For JPEGs the decoder is configured to scale down by the largest power
+    of two (1/2, 1/4, 1/8) in the DCT domain that still yields an image
+    not smaller than size. If mode is given, the decoder produces it
+    directly where possible, e.g., grayscale from a color JPEG.
+    The image is decoded lazily, as with Image.open.
+    """
+    img = Image.open(source)
+    img.draft(mode, size)
+    return img
+
+def fit_size(image_size, size):
+    """Returns the largest size with the aspect ratio of image_size that
+    fits into size, but never enlarges.
+    """
+    scale = min(1.0, min(float(a) / b for a, b in zip(size, image_size)))
+    return tuple(max(1, int(a * scale)) for a in image_size)
+
+def fit(image, size, resample=Image.ANTIALIAS):
+    """Returns image scaled down to fit into size.
+
+    Unlike Image.thumbnail, the given image is left untouched, so one
+    decoded picture can be shared by differently sized layouts.
+    """
+    new_size = fit_size(image.size, size)
+    if new_size == image.size:
+        return image
+    return image.resize(new_size, resample)
+
+def load_scaled(source, size, mode=None, resample=Image.ANTIALIAS):
+    """Decodes an image to fit into size.
+
+    Most of the reduction is done by the JPEG decoder (see open_draft),
+    only the remaining factor of less than two is resampled.
+    """
+    img = open_draft(source, size, mode)
+    img.load()
+    if mode is not None and img.mode != mode:
+        img = img.convert(mode)
+    return fit(img, size, resample)
+
+def get_cached(cache, key, create, max_entries=8):
+    """Returns cache[key], calling create() to fill it in if missing.
+
+    The dict may be shared by threads (e.g., preview and capture) without
+    a lock, as there is no lookup after the check: a concurrent clear can't
+    raise a KeyError, at worst a value is created twice. It is meant for a
+    few sizes, so the cache is simply emptied once it is full.
+    """
+    value = cache.get(key)
+    if value is None:
+        if len(cache) >= max_entries:
+            cache.clear()
+        value = create()
+        cache[key] = value
+    return value
+
+def union_size(*sizes):
+    """Returns the smallest size that contains all given sizes"""
+    return tuple(max(size[i] for size in sizes) for i in range(2))
+
+def encode_jpeg_bands(bands, size, mode, quality=75):
+    """Encodes a picture given as horizontal bands (y, band) to a JPEG.
+
+    If cjpeg is available, the bands are streamed to it as they come, so
+    the picture is never in memory as a whole. Otherwise they are put
+    together first. Returns the JPEG data.
+    """
+    if mode not in ('L', 'RGB'):
+        raise ValueError("Can't encode bands of mode " + mode)
+    if not cjpeg_enabled:
+        image = Image.new(mode, size)
+        for y, band in bands:
+            image.paste(band, (0, y))
+        buff = StringIO.StringIO()
+        image.save(buff, "JPEG", quality=quality)
+        return buff.getvalue()
+
+    # Feed cjpeg a PGM/PPM stream, its output goes to a file so it never
+    # blocks on a full pipe
+    output = tempfile.TemporaryFile()
+    try:
+        process = subprocess.Popen(['cjpeg', '-quality', str(quality)],
+                                   stdin=subprocess.PIPE, stdout=output)
+        try:
+            header = "P5" if mode == 'L' else "P6"
+            process.stdin.write(header + "\n%d %d\n255\n" % size)
+            for y, band in bands:
+                process.stdin.write(band.tobytes())
+            process.stdin.close()
+        except:
+            process.kill()
+            process.wait()
+            raise
+        if process.wait() != 0:
+            raise IOError("cjpeg failed with exit code " + str(process.returncode))
+        output.seek(0)
+        return output.read()
+    finally:
+        output.close()
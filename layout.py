@@ -0,0 +1,260 @@
+import json
+import os
+
+from PIL import Image, ImageDraw, ImageFont
+
+from imaging import fit
+
+yaml_enabled = False
+
+try:
+    import yaml
+    yaml_enabled = True
+except ImportError:
+    pass
+
+
+class LayoutException(Exception):
+    """Custom exception class to handle layout errors"""
+
+
+# TrueType fonts, loaded once per file and size
+fonts = {}
+
+def get_font(filename, size):
+    key = (filename, size)
+    if key not in fonts:
+        fonts[key] = ImageFont.truetype(filename, size, encoding="unic")
+    return fonts[key]
+
+
+class Layout:
+    """Assembles shots into one picture as described by a template.
+
+    A template is a JSON (or, if PyYAML is available, YAML) file with the
+    following entries, all coordinates in pixels of the output picture:
+
+    * size: Output size, if it is not given by the caller
+    * background: Background color
+    * grid: Slots arranged in a grid, with
+      - columns, rows: Number of cells
+      - outer_border: [x, y] border around the grid
+      - inner_border: [x, y] space between neighbouring cells
+      - shots: Index of the shot shown in each cell, row by row
+      - align: Position of the pictures inside their cells, "inward"
+        (towards the center of the grid), "center" or "top-left"
+    * slots: Additional slots given as {shot, box: [x, y, w, h], align},
+      align being [0..1, 0..1] (left/top to right/bottom)
+    * layers: Static texts and images, drawn below the pictures unless
+      they have "above": true. Texts have text, font, size, color and
+      box, images have file and box (pictures are fit into the box).
+
+    Everything except the pictures is rendered once per output size and
+    cached, so assembling only pastes the slots.
+    """
+
+    def __init__(self, template, mode='RGB', directory='.'):
+        self.template  = template
+        self.mode      = mode
+        self.directory = directory
+        self._static   = {}
+
+    @classmethod
+    def load(cls, filename, mode='RGB'):
+        try:
+            with open(filename) as f:
+                if filename.endswith(('.yaml', '.yml')):
+                    if not yaml_enabled:
+                        raise LayoutException("PyYAML is required for '" + filename + "'")
+                    template = yaml.safe_load(f)
+                else:
+                    template = json.load(f)
+        except (IOError, ValueError) as e:
+            raise LayoutException("Can't load layout '" + filename + "': " + str(e))
+        return cls(template, mode, os.path.dirname(filename))
+
+    def get_size(self, size=None):
+        if 'size' in self.template:
+            return tuple(self.template['size'])
+        if size is None:
+            raise LayoutException("Layout has no size and none was given")
+        return tuple(size)
+
+    def slots(self, size=None):
+        """Returns the slots as list of (shot, box, align)"""
+        return self._get_static(self.get_size(size))['slots']
+
+    def slot_size(self, size=None):
+        """Returns the smallest size that fits the pictures of all slots"""
+        boxes = [ box for shot, box, align in self.slots(size) ]
+        return (max(box[2] for box in boxes), max(box[3] for box in boxes))
+
+    def render(self, images, size=None):
+        """Assembles the given shots. They are not modified."""
+        size = self.get_size(size)
+        static = self._get_static(size)
+        output_image = self._new_base(static, (0, 0) + size)
+
+        # Scale each shot only once, even if shown in several slots
+        scaled = {}
+        for shot, box, align in static['slots']:
+            img = self._get_scaled(images, scaled, shot, box)
+            output_image.paste(img, self._offset(img, box, align))
+
+        if static['overlay']:
+            overlay, mask = static['overlay']
+            output_image.paste(overlay, (0, 0), mask)
+        return output_image
+
+    def render_bands(self, images, size=None, band_height=256):
+        """Assembles the given shots in horizontal bands, top to bottom.
+
+        Yields (y, band) for each band. Shots are scaled once the first
+        band reaches their slots and released once the bands have passed
+        them, so the whole picture is never in memory at once (except for
+        layers above the pictures).
+        """
+        size = self.get_size(size)
+        static = self._get_static(size)
+        scaled = {}
+        for y in range(0, size[1], band_height):
+            bottom = min(y + band_height, size[1])
+            band = self._new_base(static, (0, y, size[0], bottom))
+            for shot, box, align in static['slots']:
+                if box[1] < bottom and box[1] + box[3] > y:
+                    img = self._get_scaled(images, scaled, shot, box)
+                    offset = self._offset(img, box, align)
+                    band.paste(img, (offset[0], offset[1] - y))
+
+            if static['overlay']:
+                overlay, mask = static['overlay']
+                crop = (0, y, size[0], bottom)
+                band.paste(overlay.crop(crop), (0, 0), mask.crop(crop))
+
+            # Release the shots that no later band shows
+            for key in list(scaled):
+                if all(box[1] + box[3] <= bottom for shot, box, align in static['slots']
+                       if (shot, box[2], box[3]) == key):
+                    del scaled[key]
+            yield y, band
+
+    def _new_base(self, static, crop):
+        size = (crop[2] - crop[0], crop[3] - crop[1])
+        if static['base'] is None:
+            return Image.new(self.mode, size, static['background'])
+        # Older versions of PIL crop lazily
+        band = static['base'].crop(crop)
+        band.load()
+        return band
+
+    def _get_scaled(self, images, scaled, shot, box):
+        key = (shot, box[2], box[3])
+        if key not in scaled:
+            scaled[key] = fit(images[shot], box[2:])
+        return scaled[key]
+
+    def _offset(self, img, box, align):
+        return ( box[0] + int(align[0] * (box[2] - img.size[0])) ,
+                 box[1] + int(align[1] * (box[3] - img.size[1])) )
+
+    def _get_static(self, size):
+        if size not in self._static:
+            self._static[size] = self._render_static(size)
+        return self._static[size]
+
+    def _render_static(self, size):
+        slots = self._grid_slots(size) + [
+            ( slot['shot'], tuple(slot['box']), tuple(slot.get('align', (0.5, 0.5))) )
+            for slot in self.template.get('slots', []) ]
+
+        background = self.template.get('background', 'black')
+        if isinstance(background, list):
+            background = tuple(background)
+        below = [ l for l in self.template.get('layers', []) if not l.get('above') ]
+        above = [ l for l in self.template.get('layers', []) if l.get('above') ]
+
+        # Only keep a base picture if there is more than the background
+        base = None
+        if below:
+            base = Image.new(self.mode, size, background)
+            for layer in below:
+                self._draw_layer(base, None, layer)
+
+        # Layers above the pictures are pasted through a mask
+        overlay = None
+        if above:
+            overlay = ( Image.new(self.mode, size), Image.new('L', size, 0) )
+            for layer in above:
+                self._draw_layer(overlay[0], overlay[1], layer)
+
+        return { 'base': base, 'background': background, 'overlay': overlay,
+                 'slots': slots }
+
+    def _grid_slots(self, size):
+        grid = self.template.get('grid')
+        if not grid:
+            return []
+        columns, rows = grid['columns'], grid['rows']
+        outer = grid.get('outer_border', (0, 0))
+        inner = grid.get('inner_border', (0, 0))
+        shots = grid.get('shots', range(columns * rows))
+        cell = ( (size[0] - 2 * outer[0] - (columns - 1) * inner[0]) // columns ,
+                 (size[1] - 2 * outer[1] - (rows - 1) * inner[1]) // rows )
+
+        slots = []
+        for i, shot in enumerate(shots):
+            column, row = i % columns, i // columns
+            box = ( outer[0] + column * (cell[0] + inner[0]) ,
+                    outer[1] + row * (cell[1] + inner[1]) ,
+                    cell[0], cell[1] )
+            align = grid.get('align', 'center')
+            if align == 'inward':
+                align = ( self._inward(column, columns), self._inward(row, rows) )
+            elif align == 'top-left':
+                align = (0, 0)
+            elif align == 'center':
+                align = (0.5, 0.5)
+            else:
+                raise LayoutException("Invalid grid alignment: " + str(align))
+            slots.append((shot, box, align))
+        return slots
+
+    def _inward(self, index, count):
+        if count == 1:
+            return 0.5
+        return 1 - float(index) / (count - 1)
+
+    def _draw_layer(self, image, mask, layer):
+        box = layer.get('box', (0, 0) + image.size)
+        if layer['type'] == 'text':
+            font = get_font(layer['font'], layer.get('size', 80))
+            text = layer['text']
+            color = layer.get('color', 'black')
+            if isinstance(color, list):
+                color = tuple(color)
+            w, h = font.getsize(text)
+            pos = ( box[0] + self._align_offset(layer.get('align', 'center'), box[2], w) ,
+                    box[1] )
+            ImageDraw.Draw(image).text(pos, text, color, font)
+            if mask is not None:
+                ImageDraw.Draw(mask).text(pos, text, 255, font)
+        elif layer['type'] == 'image':
+            img = Image.open(os.path.join(self.directory, layer['file']))
+            img = fit(img, box[2:])
+            pos = ( box[0] + (box[2] - img.size[0]) // 2 ,
+                    box[1] + (box[3] - img.size[1]) // 2 )
+            alpha = img.split()[-1] if img.mode in ('RGBA', 'LA') else None
+            image.paste(img.convert(self.mode), pos, alpha)
+            if mask is not None:
+                mask.paste(255, pos + (pos[0] + img.size[0], pos[1] + img.size[1]), alpha)
+        else:
+            raise LayoutException("Invalid layer type: " + str(layer['type']))
+
+    def _align_offset(self, align, space, width):
+        if align == 'left':
+            return 0
+        elif align == 'center':
+            return (space - width) // 2
+        elif align == 'right':
+            return space - width
+        raise LayoutException("Invalid text alignment: " + str(align))
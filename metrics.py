@@ -0,0 +1,228 @@
+import gc
+import json
+import logging
+import logging.handlers
+import os
+import resource
+from collections import deque
+from threading import Thread, Lock
+from time import time
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+
+def current_rss():
+    """Returns the resident set size of this process in MB"""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / (1024.0 * 1024.0)
+
+
+class MemoryException(Exception):
+    """Raised if a task exceeds its memory budget"""
+    def __init__(self, message):
+        self.message = message
+
+
+class MemoryBudget:
+    """Enforces a cap (in MB) on the memory of this process during a task.
+
+    The resident set size is sampled by check(), e.g., before each large
+    allocation, and the highest sample is kept as peak.
+    """
+
+    def __init__(self, cap=None):
+        self.cap  = cap
+        self.peak = 0.0
+
+    def check(self):
+        rss = current_rss()
+        if self.cap and rss > self.cap:
+            # Give freed images a chance to go before giving up
+            gc.collect()
+            rss = current_rss()
+            if rss > self.cap:
+                raise MemoryException("Using %d MB, more than the %d MB allowed"
+                                      % (rss, self.cap))
+        self.peak = max(self.peak, rss)
+        return rss
+
+
+class Histogram:
+    """Durations of one phase.
+
+    Count, sum and maximum cover all observations, quantiles the most
+    recent ones only, so memory and the cost of observing stay constant.
+    """
+
+    def __init__(self, window=1024):
+        self.count   = 0
+        self.sum     = 0.0
+        self.max     = 0.0
+        self.samples = deque(maxlen=window)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum   += value
+        if value > self.max:
+            self.max = value
+        self.samples.append(value)
+
+    def quantile(self, q):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def summary(self):
+        return { 'count': self.count, 'p50': self.quantile(0.5),
+                 'p95': self.quantile(0.95), 'max': self.max }
+
+
+class Timer:
+    """Context manager observing the duration of its block"""
+
+    def __init__(self, metrics, phase):
+        self.metrics = metrics
+        self.phase   = phase
+
+    def __enter__(self):
+        self.start = time()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.observe(self.phase, time() - self.start)
+
+
+class Metrics:
+    """Phase timings and counters of the photobooth.
+
+    Phases are timed with `with metrics.timer('capture'): ...`, which
+    costs two clock reads and a short lock, so it can stay enabled in
+    production. Timings of a session are summed up and written as one JSON
+    line, together with the histograms (p50/p95/max), to a rotating log
+    file. All histograms and counters can also be served over HTTP in
+    Prometheus' text format.
+    """
+
+    def __init__(self):
+        self.lock       = Lock()
+        self.histograms = {}
+        self.counters   = {}
+        self.gauges     = {}
+        self.record     = None
+        self.log        = None
+
+    def timer(self, phase):
+        return Timer(self, phase)
+
+    def observe(self, phase, seconds):
+        with self.lock:
+            if phase not in self.histograms:
+                self.histograms[phase] = Histogram()
+            self.histograms[phase].observe(seconds)
+            if self.record is not None:
+                phases = self.record['phases']
+                phases[phase] = phases.get(phase, 0.0) + seconds
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        """Sets a value that is reported as is, e.g., a peak memory use"""
+        with self.lock:
+            self.gauges[name] = value
+            if self.record is not None:
+                self.record[name] = value
+
+    def summary(self):
+        """Returns p50/p95/max of all phases, all counters and gauges"""
+        with self.lock:
+            return { 'phases': dict((phase, histogram.summary())
+                                    for phase, histogram in self.histograms.items()),
+                     'counters': dict(self.counters), 'gauges': dict(self.gauges) }
+
+    def open_log(self, filename, max_bytes=1024*1024, backup_count=5):
+        """Writes records as JSON lines to filename, rotating it at max_bytes"""
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes,
+                                                       backupCount=backup_count)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self.log = logging.getLogger('photobooth.metrics')
+        self.log.propagate = False
+        self.log.setLevel(logging.INFO)
+        self.log.addHandler(handler)
+
+    def start_record(self, kind):
+        """Starts summing up phase timings, e.g., for a session"""
+        with self.lock:
+            self.record = { 'type': kind, 'start': time(), 'phases': {} }
+
+    def finish_record(self, **fields):
+        """Completes the current record and writes it to the log"""
+        with self.lock:
+            record, self.record = self.record, None
+        if record is None:
+            return
+        record['duration'] = time() - record['start']
+        record.update(fields)
+        self.observe(record['type'], record['duration'])
+        self.count(record['type'] + 's')
+        if self.log is not None:
+            self.log.info(json.dumps(record, sort_keys=True))
+            self.log.info(json.dumps(dict(self.summary(), type='summary', time=time()),
+                                     sort_keys=True))
+
+    def prometheus(self):
+        """Returns all histograms and counters in Prometheus' text format"""
+        lines = [ "# TYPE photobooth_phase_seconds summary" ]
+        with self.lock:
+            for phase in sorted(self.histograms):
+                histogram = self.histograms[phase]
+                label = 'phase="%s"' % phase
+                for q in (0.5, 0.95):
+                    lines.append('photobooth_phase_seconds{%s,quantile="%s"} %f'
+                                 % (label, q, histogram.quantile(q)))
+                lines.append('photobooth_phase_seconds_sum{%s} %f' % (label, histogram.sum))
+                lines.append('photobooth_phase_seconds_count{%s} %d' % (label, histogram.count))
+            lines.append("# TYPE photobooth_phase_seconds_max gauge")
+            for phase in sorted(self.histograms):
+                lines.append('photobooth_phase_seconds_max{phase="%s"} %f'
+                             % (phase, self.histograms[phase].max))
+            for name in sorted(self.counters):
+                lines.append("# TYPE photobooth_%s_total counter" % name)
+                lines.append("photobooth_%s_total %d" % (name, self.counters[name]))
+            for name in sorted(self.gauges):
+                lines.append("# TYPE photobooth_%s gauge" % name)
+                lines.append("photobooth_%s %f" % (name, self.gauges[name]))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port, host='127.0.0.1'):
+        """Serves /metrics on the given port in a background thread"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer((host, port), Handler)
+        thread = Thread(target=server.serve_forever, name='metrics')
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+# Shared by all modules of the photobooth
+metrics = Metrics()
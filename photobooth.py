@@ -3,22 +3,34 @@
 # Created by br _at_ re-web _dot_ eu, 2015-2016
 
 import os
+import socket
 import traceback
 from datetime import datetime
-from glob import glob
 from sys import exit
+from threading import Lock
 from time import sleep, time
 import cStringIO as StringIO
-import pygame
 
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image
 
-from gui import GUI_PyGame as GuiModule
+from gui import GUI_PyGame as GuiModule, ScreenAtlas, image_to_surface
+from imaging import cjpeg_enabled, encode_jpeg_bands, fit, fit_size, load_scaled, union_size
+from layout import Layout
+from metrics import MemoryBudget, MemoryException, metrics
+from picturelist import PictureList
+from scheduler import Scheduler
+from storage import Storage
 # from camera import CameraException, Camera_cv as CameraModule
 from camera import CameraException, Camera_gPhoto as CameraModule
 from slideshow import Slideshow
+import chromakey
+import animation
 from events import Rpi_GPIO as GPIO
+from filters import get_filter
 from btmon import BTMon
+from worker import Worker
+from preview import PreviewPipeline
+from printer import PrintQueue, Printer_CUPS as PrinterModule
 
 #####################
 ### Configuration ###
@@ -33,6 +45,10 @@ image_size = (2352, 1568)
 # Size of pictures in the assembled image
 thumb_size = (1176, 784)
 
+# Layout templates of the assembled picture and the print sheet
+screen_layout = "layouts/screen.json"
+print_layout = "layouts/print.json"
+
 # Image basename
 picture_basename = datetime.now().strftime("%Y-%m-%d/pic")
 print_basename = datetime.now().strftime("%Y-%m-%d-print/pic")
@@ -60,64 +76,95 @@ idle_slideshow = True
 # Display time of pictures in the slideshow
 slideshow_display_time = 5
 
-mode = 'L'
+# CUPS printer to use (None for the default printer)
+printer_name = None
 
-btaddr1 = "FF:FF:80:00:76:85"
-btaddr2 = "FF:FF:C3:0D:93:BB"
+# Maximum number of print jobs waiting for the printer
+max_print_jobs = 3
 
+# Target frame rate of the live preview
+preview_fps = 15
 
-###############
-### Classes ###
-###############
+# Seconds to keep the camera's viewfinder running after it was used
+camera_keep_warm = 60
 
-class PictureList:
-    """A simple helper class.
+# Assemble with as little memory as possible (e.g., on a Pi with 512MB):
+# the print sheet is rendered after the screen picture, in bands that are
+# streamed to cjpeg (the sheet is only put together as a whole without it)
+low_memory = False
 
-    It provides the filenames for the assembled pictures and keeps count
-    of taken and previously existing pictures.
-    """
+# Memory (resident, in MB) the photobooth may use while rendering the
+# print sheet in low memory mode, the print is skipped if it would take more
+assembly_memory_cap = 300
 
-    def __init__(self, basename):
-        """Initialize filenames to the given basename and search for
-        existing files. Set the counter accordingly.
-        """
+# Also make an animated GIF (and an MP4 loop, if ffmpeg is installed) of
+# the shots of each session, playing them forth and back
+animations = True
 
-        # Set basename and suffix
-        self.basename = basename
-        self.suffix = ".jpg"
-        self.count_width = 5
+# Maximum size of the animations and the time each shot is shown (in seconds)
+animation_size = (640, 480)
+animation_frame_time = 0.3
 
-        # Ensure directory exists
-        dirname = os.path.dirname(self.basename)
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
+# File to log the timings of each session to (JSON lines, None to disable)
+metrics_log = "log-metrics.jsonl"
 
-        # Find existing files
-        count_pattern = "[0-9]" * self.count_width
-        pictures = glob(self.basename + count_pattern + self.suffix)
+# Local port serving timings in Prometheus' format (None to disable)
+metrics_port = 9101
 
-        # Get number of latest file
-        if len(pictures) == 0:
-            self.counter = 0
-        else:
-            pictures.sort()
-            last_picture = pictures[-1]
-            self.counter = int(last_picture[-(self.count_width+len(self.suffix)):-len(self.suffix)])
+# Directory to keep pre-rendered screens in between starts
+screen_cache_directory = ".cache/screens"
+
+# Look of the pictures, also shown in the preview (see presets in
+# filters.py), presets can be combined, e.g., 'sepia+vignette'
+filter_preset = 'bw'
+
+# Picture to replace a green screen behind the guests by, in the preview
+# and the shots (None to disable, needs NumPy)
+chroma_key_background = None
+
+# Hue of the screen in degrees (green: 120, blue: 240) and how far off
+# the hue of the screen may be in the pictures
+chroma_key_hue = 120
+chroma_key_tolerance = 30
+
+btaddr1 = "FF:FF:80:00:76:85"
+btaddr2 = "FF:FF:C3:0D:93:BB"
 
-        # Print initial infos
-        print("Info: Number of last existing file: " + str(self.counter))
-        print("Info: Saving assembled pictures as: " + self.basename + "XXXXX.jpg")
 
-    def get(self, count):
-        return self.basename + str(count).zfill(self.count_width) + self.suffix
+###############
+### Screens ###
+###############
 
-    def get_last(self):
-        return self.get(self.counter)
+def fixed_screens(pose_times):
+    """Returns all fixed screens as lists of (message, color), with
+    countdown digits for the given pose times (negative without preview)
+    """
+    red, black = (255, 0, 0), (0, 0, 0)
+    screens = {
+        'idle':         [ (u"                    Ta bild\n\n\n\n\n\n\n\n\n", red),
+                          (u"\n\n\n\n\n\n\n\nPreview                   ", black) ],
+        'pose':         [ (u"POSERA!\n\nTar fyra bilder...", black) ],
+        'wait':         [ (u"Vänta!\n\nLaddar...", black) ],
+        'cancel':       [ (u"\n\n\n\n\n\n\n\nAvbryt                    ", black) ],
+        'print_choice': [ (u"                    Skriv ut\n\n\n\n\n\n\n\n\n", red),
+                          (u"\n\n\n\n\n\n\n\nAvbryt                 ", black) ],
+        'printer_busy': [ (u"Skrivaren är upptagen!\n\nFörsök igen senare", black) ],
+        'shutdown':     [ (u"Stänger av...", black) ],
+    }
+    for x in range(4):
+        screens['shot_%d' % x] = [ (u"OMELETT!!!\n\n" + str(x+1) + " av 4", black) ]
+    for i in range(1, max_print_jobs + 1):
+        screens['printing_%d' % i] = [ (u"Skriver ut...\n\n" + str(i) + u" i kön", black) ]
+    # Countdown digits, centered and next to the preview
+    for i in range(1, max([ 20 ] + [ abs(t) for t in pose_times ]) + 1):
+        screens['digit_%d' % i] = [ (str(i), black) ]
+        screens['countdown_%d' % i] = [ (str(i) + "                                    ", black) ]
+    return screens
 
-    def get_next(self):
-        self.counter += 1
-        return self.get(self.counter)
 
+###############
+### Classes ###
+###############
 
 class Photobooth:
     """The main class.
@@ -129,12 +176,61 @@ class Photobooth:
                  pose_time_first, pose_time, display_time, trigger_channel,
                  shutdown_channel, lamp_channel, idle_slideshow,
                  slideshow_display_time):
+        if metrics_log:
+            metrics.open_log(metrics_log)
+        if metrics_port:
+            try:
+                metrics.serve(metrics_port)
+            except socket.error as e:
+                print('Warning: Serving metrics failed (' + str(e) + ')')
+
         self.display      = GuiModule('Photobooth', display_size)
+        self.atlas        = ScreenAtlas(self.display,
+                                        fixed_screens((pose_time_first, pose_time)),
+                                        screen_cache_directory)
+        self.atlas.prepare()
+        self.display.set_atlas(self.atlas)
         self.pictures     = PictureList(picture_basename)
         self.prints       = PictureList(print_basename)
-        self.camera       = CameraModule(picture_size)
+        self.camera       = CameraModule(picture_size, keep_warm=camera_keep_warm)
+
+        # Shots are downloaded and decoded in the background while the
+        # next countdown runs, the lock serializes access to the camera
+        self.camera_lock  = Lock()
+        self.capture      = Worker('capture')
+
+        # The print sheet is rendered speculatively once all shots are in
+        self.renderer     = Worker('render')
+        if low_memory and not cjpeg_enabled:
+            print("Warning: cjpeg not found. The print sheet is put together as a whole.")
+        # All files are written in the background, the assembled pictures
+        # are shown from memory meanwhile
+        self.storage      = Storage()
+        self.animations   = None
+        if animations and not animation.gif_enabled:
+            print("Warning: Animated GIFs need Pillow 3.4 or later. Animations disabled.")
+        elif animations:
+            self.animations = animation.AnimationEncoder(self.storage, animation_size,
+                                                         animation_frame_time)
+        self.pending_print = os.path.join(os.path.dirname(self.prints.basename),
+                                          ".pending" + self.prints.suffix)
+        self.printer      = PrintQueue(PrinterModule(printer_name), max_print_jobs)
+        self.preview      = PreviewPipeline(self.camera, self.camera_lock,
+                                            self.decode_preview)
 
         self.pic_size     = picture_size
+        self.print_size   = (picture_size[1], picture_size[0])
+        self.filter       = get_filter(filter_preset)
+        self.chroma_key   = None
+        if chroma_key_background and not chromakey.numpy_enabled:
+            print("Warning: NumPy could not be loaded. Chroma key disabled.")
+        elif chroma_key_background:
+            self.chroma_key = chromakey.ChromaKey(Image.open(chroma_key_background),
+                                                  chroma_key_hue, chroma_key_tolerance)
+        # Keying needs color, the filter may turn it into black and white
+        self.decode_mode  = 'RGB' if self.chroma_key else self.filter.input_mode
+        self.screen_layout = Layout.load(screen_layout, self.filter.mode)
+        self.print_layout = Layout.load(print_layout, self.filter.mode)
         self.pose_time_first = pose_time_first
         self.pose_time    = pose_time
         self.display_time = display_time
@@ -143,21 +239,30 @@ class Photobooth:
         self.shutdown_channel = shutdown_channel
         self.lamp_channel     = lamp_channel
 
+        self.scheduler    = Scheduler(self.display)
+        self.idle_timer   = None
+
         self.idle_slideshow = idle_slideshow
         if self.idle_slideshow:
             self.slideshow_display_time = slideshow_display_time
-            self.slideshow = Slideshow(display_size, display_time, 
-                                       os.path.dirname(os.path.realpath(picture_basename)))
+            # Start with the pictures of the index, named as the watcher
+            # reports new ones
+            directory = os.path.dirname(os.path.realpath(picture_basename))
+            filelist = [ os.path.join(directory, os.path.basename(filename))
+                         for filename in self.pictures.get_all() ]
+            self.slideshow = Slideshow(display_size, display_time, directory,
+                                       filelist=filelist)
+            self.slideshow.display.set_atlas(self.atlas)
 
         input_channels    = [ trigger_channel, shutdown_channel ]
         output_channels   = [ lamp_channel ]
         self.gpio         = GPIO(self.handle_gpio, input_channels, output_channels)
-        self.bt1          = BTMon(btaddr1, 1, self.handle_bt)
-        self.bt2          = BTMon(btaddr2, 2, self.handle_bt)
+        self.bt1          = BTMon(btaddr1, 1, self.handle_bt) if btaddr1 else None
+        self.bt2          = BTMon(btaddr2, 2, self.handle_bt) if btaddr2 else None
 
     def teardown(self):
         self.display.clear()
-        self.display.show_message(u"Stänger av...")
+        self.display.show_screen('shutdown')
         self.display.apply()
         self.gpio.set_output(self.lamp_channel, 0)
         self.display.cancel_events()
@@ -165,32 +270,52 @@ class Photobooth:
         self.gpio.teardown()
         exit(0)
 
+    def set_idle(self):
+        """Idles the camera, or retries once its keep warm period is over"""
+        if self.idle_timer is not None:
+            self.scheduler.cancel(self.idle_timer)
+            self.idle_timer = None
+        with self.camera_lock:
+            remaining = self.camera.set_idle()
+        if remaining:
+            self.idle_timer = self.scheduler.call_later(remaining, self.set_idle)
+
     def _run_plain(self):
+        self.scheduler.clear()
         while True:
-            self.camera.set_idle()
+            self.set_idle()
 
             # Display default message
             self.display.clear()
             #self.display.show_message(u"Tryck på knappen!")
-            self.display.show_message(u"                    Ta bild\n\n\n\n\n\n\n\n\n", color=(255,0,0))
-            self.display.show_message(u"\n\n\n\n\n\n\n\nPreview                   ")
+            self.display.show_screen('idle')
             #self.display.show_message(u"Ta bild       Preview           \n   |         |                 \n   |         |                 \n    v       v                 \n   R        S                 \n")
             self.display.apply()
 
-            # Wait for an event and handle it
-            event = self.display.wait_for_event()
-            self.handle_event(event)
+            # Wait for an event (idling the camera meanwhile) and handle it
+            r, e = self.scheduler.wait()
+            while not r:
+                r, e = self.scheduler.wait()
+            self.handle_event(e)
 
     def _run_slideshow(self):
+        # Slides are advanced by timers, in between the loop sleeps until
+        # an event arrives
+        self.scheduler.clear()
+        self.scheduler.call_later(0, self._next_slide)
         while True:
-            self.camera.set_idle()
-            #self.slideshow.display_next(u"Tryck på knappen!")
-            #self.slideshow.display_next(u"Ta bild       Preview           \n   |         |                 \n   |         |                 \n   v         v                 \n   R        S                 \n")
-            self.slideshow.display_next(u"\n\n\n\n\n\n\n\nPreview                   "
-                                       ,u"                    Ta bild\n\n\n\n\n\n\n\n\n")
-            tic = time()
-            while time() - tic < self.slideshow_display_time:
-                self.check_and_handle_events()
+            r, e = self.scheduler.wait()
+            if r:
+                self.handle_event(e)
+
+    def _next_slide(self):
+        self.set_idle()
+        #self.slideshow.display_next(u"Tryck på knappen!")
+        #self.slideshow.display_next(u"Ta bild       Preview           \n   |         |                 \n   |         |                 \n   v         v                 \n   R        S                 \n")
+        self.slideshow.display_next(screen='idle')
+        # Decode the next pictures once the slide is on screen
+        self.scheduler.call_later(0.1, self.slideshow.prefetch)
+        self.scheduler.call_later(self.slideshow_display_time, self._next_slide)
 
     def run(self):
         while True:
@@ -275,197 +400,98 @@ class Photobooth:
         exit(1)
 
 
-    def assemble_pictures(self, input_filenames, size):
-        """Assembles four pictures into a 2x2 grid
-
-        It assumes, all original pictures have the same aspect ratio as
-        the resulting image.
-
-        For the thumbnail sizes we have:
-        h = (H - 2 * a - 2 * b) / 2
-        w = (W - 2 * a - 2 * b) / 2
-
-                                    W
-               |---------------------------------------|
-
-          ---  +---+-------------+---+-------------+---+  ---
-           |   |                                       |   |  a
-           |   |   +-------------+   +-------------+   |  ---
-           |   |   |             |   |             |   |   |
-           |   |   |      0      |   |      1      |   |   |  h
-           |   |   |             |   |             |   |   |
-           |   |   +-------------+   +-------------+   |  ---
-         H |   |                                       |   |  2*b
-           |   |   +-------------+   +-------------+   |  ---
-           |   |   |             |   |             |   |   |
-           |   |   |      2      |   |      3      |   |   |  h
-           |   |   |             |   |             |   |   |
-           |   |   +-------------+   +-------------+   |  ---
-           |   |                                       |   |  a
-          ---  +---+-------------+---+-------------+---+  ---
-
-               |---|-------------|---|-------------|---|
-                 a        w       2*b       w        a
+    def assemble_pictures(self, input_images, size):
+        """Assembles four pictures as given by the screen layout
+
+        The pictures are expected to be decoded already, at least as large
+        as the slots of the layout, e.g., by the capture worker. They are
+        not modified.
+
+        Returns the assembled image and its filename. The image is encoded
+        and saved by the storage thread, it is added to the picture list (and
+        hence the slideshow) once it has been written completely.
         """
+        with metrics.timer('compose'):
+            output_image = self.screen_layout.render(input_images, size)
 
-        # Thumbnail size of pictures
-        outer_border = 40
-        inner_border = 20
-        thumb_box = ( int( size[0] / 2 ) ,
-                      int( size[1] / 2 ) )
-        thumb_size = ( thumb_box[0] - outer_border - inner_border ,
-                       thumb_box[1] - outer_border - inner_border )
-
-        # Create output image with white background
-        output_image = Image.new('RGB', size, (0, 0, 0))
-
-        # Image 0
-        img = Image.open(input_filenames[0])
-        img.thumbnail(thumb_size)
-        offset = ( thumb_box[0] - inner_border - img.size[0] ,
-                   thumb_box[1] - inner_border - img.size[1] )
-        output_image.paste(img, offset)
-
-        # Image 1
-        img = Image.open(input_filenames[1])
-        img.thumbnail(thumb_size)
-        offset = ( thumb_box[0] + inner_border,
-                   thumb_box[1] - inner_border - img.size[1] )
-        output_image.paste(img, offset)
-
-        # Image 2
-        img = Image.open(input_filenames[2])
-        img.thumbnail(thumb_size)
-        offset = ( thumb_box[0] - inner_border - img.size[0] ,
-                   thumb_box[1] + inner_border )
-        output_image.paste(img, offset)
-
-        # Image 3
-        img = Image.open(input_filenames[3])
-        img.thumbnail(thumb_size)
-        offset = ( thumb_box[0] + inner_border ,
-                   thumb_box[1] + inner_border )
-        output_image.paste(img, offset)
-
-        output_image = output_image.convert(mode)
-
-        # Save assembled image
+        # Save assembled image in the background
         output_filename = self.pictures.get_next()
-        sleep(0.01)
-        output_image.save(output_filename, "JPEG")
-        sleep(0.01)
-        return output_filename
-
-    def assemble_print(self, input_filenames, size):
-        """Assembles four pictures into a 2x2 grid
-
-        It assumes, all original pictures have the same aspect ratio as
-        the resulting image.
-
-        For the thumbnail sizes we have:
-        h = (H - 2*a - 6*b) / 4
-        w = (W - 2*a - 2*b) / 2
-
-                                    W
-               |---------------------------------------|
-                   w0                w1
-          ---  +---+-------------+---+-------------+---+  ---
-           |   |                                       |   |  a
-           |   |   +-------------+   +-------------+   |  --- h0
-           |   |   |             |   |             |   |   |
-           |   |   |      0      |   |      0      |   |   |  h
-           |   |   |             |   |             |   |   |
-           |   |   +-------------+   +-------------+   |  ---
-           |   |                                       |   |  b
-           |   |   +-------------+   +-------------+   |  --- h1
-           |   |   |             |   |             |   |   |
-           |   |   |      1      |   |      1      |   |   |  h
-           |   |   |             |   |             |   |   |
-           |   |   +-------------+   +-------------+   |  ---
-         H |   |                                       |   |  b
-           |   |   +-------------+   +-------------+   |  --- h2
-           |   |   |             |   |             |   |   |
-           |   |   |      2      |   |      2      |   |   |  h
-           |   |   |             |   |             |   |   |
-           |   |   +-------------+   +-------------+   |  ---
-           |   |                                       |   |  b
-           |   |   +-------------+   +-------------+   |  --- h3
-           |   |   |             |   |             |   |   |
-           |   |   |      3      |   |      3      |   |   |  h
-           |   |   |             |   |             |   |   |
-           |   |   +-------------+   +-------------+   |  ---
-           |   |                                       |   |  a
-          ---  +---+-------------+---+-------------+---+  ---
-
-               |---|-------------|---|-------------|---|
-                 a        w        b        w        a
+        self.storage.save_image(output_image, output_filename,
+                                callback=self.pictures.add)
+        return output_image, output_filename
+
+    def assemble_print(self, input_images, size, output_filename=None, wait=False):
+        """Assembles four pictures as given by the print layout
+
+        Like assemble_pictures, it takes already decoded pictures and
+        returns the assembled image and its filename. The sheet is saved to
+        output_filename or, if none is given, the next file of the print
+        list. With wait, it returns once the sheet has been written and
+        raises if writing it failed.
         """
-
-        # Thumbnail size of pictures
-        outer_borderx = 0
-        outer_bordery = 110
-        inner_borderx = 20
-        inner_bordery = 10
-        thumb_size = ( int((size[0] - 2*outer_borderx - inner_borderx)/2) ,
-                       int((size[1] - 2*outer_bordery - 3*inner_bordery)/4) )
-        w = [outer_borderx
-            ,outer_borderx+thumb_size[0]+inner_borderx
-            ]
-        h = [outer_bordery
-            ,outer_bordery+1*(thumb_size[1]+inner_bordery)
-            ,outer_bordery+2*(thumb_size[1]+inner_bordery)
-            ,outer_bordery+3*(thumb_size[1]+inner_bordery)
-            ]
-
-        # Create output image with white background
-        output_image = Image.new('RGB', size, (255, 255, 255))
-
-        # Image 0
-        img = Image.open(input_filenames[0])
-        img.thumbnail(thumb_size, Image.ANTIALIAS)
-        output_image.paste(img, (w[0],h[0]))
-        output_image.paste(img, (w[1],h[0]))
-
-        # Image 1
-        img = Image.open(input_filenames[1])
-        img.thumbnail(thumb_size, Image.ANTIALIAS)
-        output_image.paste(img, (w[0],h[1]))
-        output_image.paste(img, (w[1],h[1]))
-
-        # Image 2
-        img = Image.open(input_filenames[2])
-        img.thumbnail(thumb_size, Image.ANTIALIAS)
-        output_image.paste(img, (w[0],h[2]))
-        output_image.paste(img, (w[1],h[2]))
-
-        # Image 3
-        img = Image.open(input_filenames[3])
-        img.thumbnail(thumb_size, Image.ANTIALIAS)
-        output_image.paste(img, (w[0],h[3]))
-        output_image.paste(img, (w[1],h[3]))
-
-        sleep(0.01)
-        output_image = output_image.convert(mode)
-
-        # Text
-        draw = ImageDraw.Draw(output_image)
-        font = ImageFont.truetype("/usr/share/fonts/truetype/freefont/FreeSans.ttf", 80, encoding="unic")
-
-        def drawTextCentered(x, y, W, text):
-            w, h = font.getsize(text)
-            draw.text((x+(W-w)/2,y), text, "black", font)
-        #drawTextCentered(0, 0, thumb_size[0], "Ylva & Simon")
-        #drawTextCentered(w[1], 0, thumb_size[0], "Ylva & Simon")
-        #bottom = outer_bordery+4*(thumb_size[1]+inner_bordery)
-        #drawTextCentered(0, bottom, thumb_size[0], "2018-06-09")
-        #drawTextCentered(w[1], bottom, thumb_size[0], "2018-06-09")
-
-        # Save assembled image
-        sleep(0.01)
-        output_filename = self.prints.get_next()
-        output_image.save(output_filename, "JPEG")
-        sleep(0.01)
-        return output_filename
+        with metrics.timer('print_compose'):
+            output_image = self.print_layout.render(input_images, size)
+
+        # Save assembled image in the background
+        callback = None
+        if output_filename is None:
+            output_filename = self.prints.get_next()
+            callback = self.prints.add
+        job = self.storage.save_image(output_image, output_filename, callback=callback)
+        if wait:
+            job.result()
+        return output_image, output_filename
+
+    def render_print(self, input_images, display_size, budget=None):
+        """Renders the pending print sheet (render worker)
+
+        Returns a display sized surface of the sheet and its filename, so
+        showing it doesn't need to read it back. The file is complete once
+        this returns, as it is needed on disk for printing. With a memory
+        budget (low memory mode), the sheet is rendered in bands.
+        """
+        if budget is not None:
+            return self._render_print_bands(input_images, display_size, budget)
+        output_image, output_filename = self.assemble_print(
+            input_images, self.print_size, self.pending_print, wait=True)
+        return image_to_surface(fit(output_image, display_size)), output_filename
+
+    def _render_print_bands(self, input_images, display_size, budget):
+        """Renders the pending print sheet band by band (low memory mode)
+
+        Bands are encoded as they come and a display sized copy of the
+        sheet is put together on the way, so the sheet as a whole is never
+        in memory.
+        """
+        size = self.print_layout.get_size(self.print_size)
+        preview = Image.new(self.filter.mode, fit_size(size, display_size))
+        scale = float(preview.size[1]) / size[1]
+
+        def bands():
+            for y, band in self.print_layout.render_bands(input_images, size):
+                budget.check()
+                top, bottom = int(y * scale), int((y + band.size[1]) * scale)
+                if bottom > top:
+                    preview.paste(band.resize((preview.size[0], bottom - top), Image.BILINEAR),
+                                  (0, top))
+                yield y, band
+
+        with metrics.timer('print_compose'):
+            data = encode_jpeg_bands(bands(), size, self.filter.mode)
+        metrics.gauge('assembly_peak_rss_mb', budget.peak)
+        # Raises if the sheet couldn't be written
+        self.storage.write(self.pending_print, data).result()
+        return image_to_surface(preview), self.pending_print
+
+    def finish_shot(self, img):
+        """Replaces the green screen (if enabled) and applies the filter to
+        a slot sized shot
+        """
+        if self.chroma_key:
+            with metrics.timer('chroma_key'):
+                img = self.chroma_key.apply(img, refine=True)
+        with metrics.timer('filter'):
+            return self.filter.apply(img)
 
     def show_preview(self, seconds, should_count=True):
         secs = abs(seconds)
@@ -473,121 +499,150 @@ class Photobooth:
             sleep(1)
             self.display.cancel_events()
         elif self.camera.has_preview() and not seconds < 0:
-            tic = time()
-            toc = time() - tic
-            while toc < secs:
-                self.display.clear()
-                buff = self.camera.take_preview_buff()
-                img = Image.open(StringIO.StringIO(buff))
-                sleep(0.01)
-                img = img.convert(mode)
-                img = img.convert("RGB")
-                pygameimg = pygame.image.frombuffer(img.tobytes(), img.size, img.mode)
-                self.display.show_picture(image=pygameimg, flip=True) 
-                self.display.show_message(str(secs - int(toc)) + "                                    ")
-                if toc < 10 and not should_count:
-                    self.display.show_message(u"\n\n\n\n\n\n\n\nAvbryt                    ")
-
-                self.display.apply()
-                sleep(0.01)
-
-                # Limit progress to 1 "second" per preview (e.g., too slow on Raspi 1)
-                toc = min(toc + 1, time() - tic)
-
-                r, e = self.display.check_for_event()
-                if not should_count and r and self.convert_event(e) == 2:
-                    self.display.cancel_events()
-                    sleep(0.01)
-                    return
+            self.preview.start()
+            try:
+                self._render_preview(secs, should_count)
+            finally:
+                self.preview.stop()
+                metrics.count('preview_dropped', self.preview.dropped)
         else:
             for i in range(secs):
                 self.display.clear()
                 sleep(0.01)
-                self.display.show_message(str(secs - i))
+                self.display.show_screen('digit_%d' % (secs - i))
                 self.display.apply()
                 sleep(1)
 
+    def decode_preview(self, buff):
+        """Decodes a preview JPEG to a mirrored surface (preview decode thread)"""
+        with metrics.timer('preview_decode'):
+            img = Image.open(StringIO.StringIO(buff))
+            # Let the JPEG decoder produce the target mode directly
+            img.draft(self.decode_mode, img.size)
+            img.load()
+        flip = True
+        if self.chroma_key:
+            # Mirror the guests only, not the background
+            with metrics.timer('preview_chroma_key'):
+                img = self.chroma_key.apply(img.transpose(Image.FLIP_LEFT_RIGHT))
+            flip = False
+        with metrics.timer('preview_filter'):
+            img = self.filter.apply(img)
+        return image_to_surface(img, flip=flip)
+
+    def _render_preview(self, secs, should_count):
+        """Renders the newest preview frame at preview_fps until the
+        countdown has run out (or the preview has been cancelled)
+        """
+        frame_time = 1.0 / preview_fps
+        shown = None
+        tic = time()
+        next_frame = tic
+        while True:
+            toc = time() - tic
+            if toc >= secs:
+                break
+
+            # Redraw only if there is a new frame or the countdown changed
+            frame_id, frame = self.preview.latest()
+            remaining = secs - int(toc)
+            if (frame_id, remaining) != shown:
+                shown = (frame_id, remaining)
+                with metrics.timer('preview_frame'):
+                    self.display.clear()
+                    if frame is not None:
+                        self.display.show_picture(image=frame, scratch=True)
+                    self.display.show_screen('countdown_%d' % remaining)
+                    if toc < 10 and not should_count:
+                        self.display.show_screen('cancel')
+                    self.display.apply()
+
+            r, e = self.display.check_for_event()
+            if not should_count and r and self.convert_event(e) == 2:
+                self.display.cancel_events()
+                return
+
+            # Keep a steady frame rate, skip frames when falling behind
+            next_frame += frame_time
+            delay = next_frame - time()
+            if delay > 0:
+                sleep(delay)
+            else:
+                next_frame = time()
+
     def take_picture(self):
         """Implements the picture taking routine"""
+        metrics.start_record('session')
         # Disable lamp
         self.gpio.set_output(self.lamp_channel, 0)
 
         # Show pose message
         self.display.clear()
-        self.display.show_message(u"POSERA!\n\nTar fyra bilder...");
+        self.display.show_screen('pose')
         self.display.apply()
         sleep(2)
 
         # Extract display and image sizes
         display_size = self.display.get_size()
-        outsize = (int(display_size[0]/2), int(display_size[1]/2))
 
-        # Take pictures
-        filenames = [i for i in range(4)]
+        # Take pictures, each shot is downloaded and decoded in the
+        # background while the countdown for the next one is running.
+        # Every shot is decoded once, large enough for screen and print.
+        thumb_size = union_size(self.screen_layout.slot_size(display_size),
+                                self.print_layout.slot_size(self.print_size))
+        shots = []
+        job = None
         for x in range(4):
-            # Countdown
-            if x==0:
-                self.show_preview(self.pose_time_first)
-            else:
-                self.show_preview(self.pose_time)
-
-            # Try each picture up to 3 times
-            remaining_attempts = 3
-            while remaining_attempts > 0:
-                remaining_attempts = remaining_attempts - 1
-
-                self.display.clear()
-                self.display.show_message(u"OMELETT!!!\n\n" + str(x+1) + " av 4")
-                self.display.apply()
-
-                tic = time()
-
-                try:
-                    filenames[x] = self.camera.take_picture("/tmp/photobooth_%02d.jpg" % x)
-                    remaining_attempts = 0
-                except CameraException as e:
-                    # On recoverable errors: display message and retry
-                    if e.recoverable:
-                        if remaining_attempts > 0:
-                            self.display.clear()
-                            self.display.show_message(e.message)  
-                            self.display.apply()
-                            sleep(5)
-                        else:
-                            raise CameraException("Giving up! Please start over!", False)
-                    else:
-                       raise e
-
-                # Measure used time and sleep a second if too fast 
-                toc = time() - tic
-                if toc < 1.0:
-                    sleep(1.0 - toc)
+            self._countdown(x)
+
+            # Wait for the previous shot before triggering the camera again
+            if job:
+                shot, retried = self._collect_shot(x-1, job, thumb_size)
+                shots.append(shot)
+                if retried:
+                    # The error and the retry took the time to pose
+                    self._countdown(x)
+            job = self._trigger_shot(x, thumb_size)
+        shots.append(self._collect_shot(3, job, thumb_size)[0])
+        images = [ shot[1] for shot in shots ]
+
+        # Render the print sheet in the background, in case it is wanted.
+        # In low memory mode only once the screen picture is assembled, so
+        # the two are never composed at the same time.
+        if not low_memory:
+            print_job = self.renderer.submit(self.render_print, images, display_size)
 
         # Show 'Wait'
         self.display.clear()
-        self.display.show_message(u"Vänta!\n\nLaddar...")
+        self.display.show_screen('wait')
         self.display.apply()
         sleep(0.01)
 
-        self.camera.set_idle()
+        self.set_idle()
         sleep(0.01)
 
-        # Assemble them
-        outfile = self.assemble_pictures(filenames, display_size)
-        sleep(0.01)
+        # Assemble them and show the result straight from memory
+        output_image, outfile = self.assemble_pictures(images, display_size)
+        if low_memory:
+            print_job = self.renderer.submit(self.render_print, images, display_size,
+                                             MemoryBudget(assembly_memory_cap))
+        with metrics.timer('display'):
+            surface = self.display.fit_image(output_image, display_size)
 
-        # Show pictures for 10 seconds
-        self.display.clear()
-        self.display.show_picture(outfile, display_size, (0,0))
-        self.display.apply()
+            # Show pictures for 10 seconds
+            self.display.clear()
+            self.display.show_picture(outfile, display_size, (0,0), image=surface)
+            self.display.apply()
         sleep(0.01)
 
         self.display.clear()
-        self.display.show_picture(outfile, display_size, (0,0))
-        self.display.show_message(u"                    Skriv ut\n\n\n\n\n\n\n\n\n", color=(255,0,0))
-        self.display.show_message(u"\n\n\n\n\n\n\n\nAvbryt                 ")
+        self.display.show_picture(outfile, display_size, (0,0), image=surface)
+        self.display.show_screen('print_choice')
         self.display.apply()
-        self.run_after(filenames)
+        if self.animations:
+            self.animations.submit(images, os.path.splitext(outfile)[0])
+        self.run_after(print_job)
+        metrics.finish_record(picture=outfile)
 
         #self.display.clear()
         #self.display.show_picture(outfile, display_size, (0,0))
@@ -598,48 +653,150 @@ class Photobooth:
         # Reenable lamp
         self.gpio.set_output(self.lamp_channel, 1)
 
-    def run_after(self,filenames):
+    def _capture_shot(self, filename, thumb_size):
+        """Takes a picture and decodes a thumbnail of it (capture worker)
+
+        If the camera can capture to memory, the thumbnail is decoded from
+        there while the original is saved in the background.
+        """
+        if self.camera.has_picture_buff():
+            with self.camera_lock, metrics.timer('capture'):
+                data = self.camera.take_picture_buff()
+            self.storage.write(filename, data)
+            source = StringIO.StringIO(data)
+        else:
+            with self.camera_lock, metrics.timer('capture'):
+                filename = source = self.camera.take_picture(filename)
+        with metrics.timer('decode'):
+            img = load_scaled(source, thumb_size, self.decode_mode)
+        return filename, self.finish_shot(img)
+
+    def _trigger_shot(self, x, thumb_size):
+        """Queues shot x on the capture worker and returns its job"""
+        self.display.clear()
+        self.display.show_screen('shot_%d' % x)
+        self.display.apply()
+
+        tic = time()
+        job = self.capture.submit(self._capture_shot,
+                                  "/tmp/photobooth_%02d.jpg" % x, thumb_size)
+
+        # Keep the message up for at least a second
+        toc = time() - tic
+        if toc < 1.0:
+            sleep(1.0 - toc)
+        return job
+
+    def _countdown(self, x):
+        """Counts down (with preview) before shot x"""
+        with metrics.timer('countdown'):
+            if x==0:
+                self.show_preview(self.pose_time_first)
+            else:
+                self.show_preview(self.pose_time)
+
+    def _collect_shot(self, x, job, thumb_size):
+        """Waits for shot x and returns ((filename, thumbnail), retried)
+
+        Each picture is tried up to 3 times.
+        """
+        remaining_attempts = 2
+        while True:
+            try:
+                with metrics.timer('capture_wait'):
+                    return job.result(), remaining_attempts < 2
+            except CameraException as e:
+                metrics.count('failed_shots')
+                # On recoverable errors: display message and retry
+                if not e.recoverable:
+                    raise e
+                if remaining_attempts == 0:
+                    raise CameraException("Giving up! Please start over!", False)
+                remaining_attempts = remaining_attempts - 1
+                self.display.clear()
+                self.display.show_message(e.message)
+                self.display.apply()
+                sleep(5)
+                job = self._trigger_shot(x, thumb_size)
+
+    def run_after(self, print_job):
         while True:
             event = self.display.wait_for_event()
-            if not self.handle_event_after(event,filenames):
+            if not self.handle_event_after(event, print_job):
                 return
 
-    def handle_event_after(self, event, filesnames):
+    def handle_event_after(self, event, print_job):
         code = self.convert_event(event)
         if code == 0:
             self.teardown()
         elif code == 1:
-            self.print_out(filesnames)
+            self.print_out(print_job)
             self.display.cancel_events()
             return False
         elif code == 2:
+            self.discard_print(print_job)
             self.display.cancel_events()
             return False
 
         return True
 
-    def print_out(self, filenames):
+    def discard_print(self, print_job):
+        """Cancels a speculative print sheet or removes it once rendered"""
+        print_job.cancel()
+        self.renderer.submit(self._remove_pending_print)
+
+    def _remove_pending_print(self):
+        self.storage.flush()
+        if os.path.exists(self.pending_print):
+            os.remove(self.pending_print)
+
+    def print_out(self, print_job):
         display_size = self.display.get_size()
 
-        # Show 'Wait'
-        self.display.clear()
-        self.display.show_message(u"Vänta!\n\nLaddar...")
-        self.display.apply()
-        sleep(0.01)
+        # Don't pile up more jobs than the printer can handle
+        if self.printer.is_full():
+            self.discard_print(print_job)
+            self.display.clear()
+            self.display.show_screen('printer_busy')
+            self.display.apply()
+            sleep(3)
+            return
 
-        # Assemble them
-        outfile = self.assemble_print(filenames, (self.pic_size[1],self.pic_size[0]))
-        sleep(0.01)
+        # Show 'Wait' if the print sheet is still being rendered
+        if not print_job.done():
+            self.display.clear()
+            self.display.show_screen('wait')
+            self.display.apply()
 
-        # Show pictures for 10 seconds
+        # Move the rendered sheet to its final name
+        try:
+            with metrics.timer('print_wait'):
+                surface, pending = print_job.result()
+            outfile = self.prints.get_next()
+            os.rename(pending, outfile)
+        except Exception as e:
+            # Skip the print, but keep the photobooth running
+            print('Error: Rendering the print failed (' + (e.message or str(e)) + ')')
+            metrics.count('failed_prints')
+            self.display.clear()
+            if isinstance(e, MemoryException):
+                self.display.show_message(u"FEL:\n\nFör lite minne för utskrift")
+            else:
+                self.display.show_message(u"FEL:\n\nUtskriften misslyckades")
+            self.display.apply()
+            sleep(3)
+            return
+        self.prints.add(outfile)
+
+        # Queue it and show the position in the queue for a moment
+        with metrics.timer('print_submit'):
+            depth = self.printer.submit(outfile)
+        metrics.count('prints')
         self.display.clear()
-        self.display.show_picture(outfile, display_size, (0,0))
-        self.display.show_message(u"Vänta!\n\nSkriver ut...")
+        self.display.show_picture(outfile, display_size, (0,0), image=surface)
+        self.display.show_screen('printing_%d' % depth)
         self.display.apply()
-        sleep(0.01)
-
-        os.system("lp -o fit-to-page %s" % outfile)
-        sleep(10)
+        sleep(2)
 
     def upload(self, filenames):
         sleep(10)
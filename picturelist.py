@@ -0,0 +1,150 @@
+import fcntl
+import json
+import os
+from glob import glob
+from threading import Lock
+
+from storage import atomic_write
+
+
+class PictureList:
+    """A simple helper class.
+
+    It provides the filenames for the assembled pictures and keeps count
+    of taken and previously existing pictures.
+
+    Counter and the list of files are kept in an index file next to the
+    pictures, so the directory only needs to be scanned if that index is
+    missing or corrupt. Numbers are reserved under a file lock and the
+    index is updated before a number is handed out, hence no number is
+    ever used twice, not even by concurrent processes or after a crash.
+    """
+
+    def __init__(self, basename):
+        """Initialize filenames to the given basename and load the index
+        or search for existing files. Set the counter accordingly.
+        """
+
+        # Set basename and suffix
+        self.basename = basename
+        self.suffix = ".jpg"
+        self.count_width = 5
+
+        # Ensure directory exists
+        dirname = os.path.dirname(self.basename)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        self.index_filename = os.path.join(dirname,
+            "." + os.path.basename(self.basename) + "index.json")
+        self.lock = Lock()
+
+        with self._locked_index():
+            if not self._load_index():
+                print("Info: Rebuilding index " + self.index_filename)
+                self._scan()
+                self._save_index()
+
+        # Print initial infos
+        print("Info: Number of last existing file: " + str(self.counter))
+        print("Info: Saving assembled pictures as: " + self.basename + "XXXXX.jpg")
+
+    def _locked_index(self):
+        return IndexLock(self.index_filename + ".lock", self.lock)
+
+    def _load_index(self):
+        try:
+            with open(self.index_filename) as f:
+                index = json.load(f)
+            self.counter = int(index['counter'])
+            self.files = [ str(name) for name in index['files'] ]
+            return True
+        except (IOError, ValueError, KeyError, TypeError):
+            return False
+
+    def _save_index(self):
+        index = { 'counter': self.counter, 'files': self.files }
+        atomic_write(self.index_filename, json.dumps(index))
+
+    def _scan(self):
+        # Find existing files
+        count_pattern = "[0-9]" * self.count_width
+        pictures = glob(self.basename + count_pattern + self.suffix)
+        pictures.sort()
+        self.files = [ os.path.basename(picture) for picture in pictures ]
+
+        # Get number of latest file
+        if len(pictures) == 0:
+            self.counter = 0
+        else:
+            self.counter = self.get_count(pictures[-1])
+
+    def get_count(self, filename):
+        return int(filename[-(self.count_width+len(self.suffix)):-len(self.suffix)])
+
+    def get(self, count):
+        return self.basename + str(count).zfill(self.count_width) + self.suffix
+
+    def get_last(self):
+        return self.get(self.counter)
+
+    def get_next(self):
+        """Reserves the next number and returns its filename"""
+        with self._locked_index():
+            # Another process may have reserved numbers meanwhile
+            counter = self.counter
+            if self._load_index():
+                counter = max(counter, self.counter)
+            self.counter = counter + 1
+            self._save_index()
+            return self.get(self.counter)
+
+    def add(self, filename):
+        """Records that a file has been written completely"""
+        with self._locked_index():
+            self._load_index()
+            name = os.path.basename(filename)
+            if name not in self.files:
+                self.files.append(name)
+                self.files.sort()
+                self._save_index()
+
+    def get_all(self):
+        """Returns the filenames of all completely written pictures.
+
+        Pictures that have been removed meanwhile (e.g., moved off the
+        card) are dropped from the index.
+        """
+        dirname = os.path.dirname(self.basename)
+        with self._locked_index():
+            self._load_index()
+            files = [ name for name in self.files
+                      if os.path.exists(os.path.join(dirname, name)) ]
+            if len(files) != len(self.files):
+                print("Info: Dropping %d missing pictures from index %s"
+                      % (len(self.files) - len(files), self.index_filename))
+                self.files = files
+                self._save_index()
+            return [ os.path.join(dirname, name) for name in files ]
+
+
+class IndexLock:
+    """Holds a thread lock and an exclusive lock on a lock file"""
+
+    def __init__(self, filename, lock):
+        self.filename = filename
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            self.fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        except:
+            self.lock.release()
+            raise
+
+    def __exit__(self, *args):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.lock.release()
@@ -0,0 +1,99 @@
+from threading import Thread, Condition
+
+
+class PreviewPipeline:
+    """Producer/consumer pipeline for live preview frames.
+
+    A fetch thread pulls preview JPEGs from the camera and a decode thread
+    turns the newest one into a frame using the given decode function.
+    Each stage only keeps the latest item, older ones are dropped, so the
+    render loop always gets the most recent frame without waiting for it.
+    """
+
+    def __init__(self, camera, camera_lock, decode):
+        self.camera      = camera
+        self.camera_lock = camera_lock
+        self.decode      = decode
+
+        self._cond     = Condition()
+        self._threads  = []
+        self._running  = False
+        self._buff     = None
+        self._frame    = None
+        self._frame_id = 0
+        self._error    = None
+        self.dropped   = 0
+
+    def start(self):
+        self._running  = True
+        self._buff     = None
+        self._frame    = None
+        self._frame_id = 0
+        self._error    = None
+        self.dropped   = 0
+        self._threads  = [ Thread(target=self._fetch, name='preview-fetch'),
+                           Thread(target=self._decode, name='preview-decode') ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def stop(self):
+        """Stops both stages and waits for a running camera access to end"""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def latest(self):
+        """Returns (frame_id, frame) of the newest decoded frame.
+
+        The frame is None until the first one has been decoded. Errors of
+        the background stages are re-raised here.
+        """
+        with self._cond:
+            if self._error is not None:
+                raise self._error
+            return self._frame_id, self._frame
+
+    def _fetch(self):
+        while True:
+            # Blocks while a shot is being downloaded
+            with self.camera_lock:
+                if not self._running:
+                    return
+                try:
+                    buff = self.camera.take_preview_buff()
+                except Exception as e:
+                    self._fail(e)
+                    return
+            with self._cond:
+                if self._buff is not None:
+                    self.dropped += 1
+                self._buff = buff
+                self._cond.notify_all()
+
+    def _decode(self):
+        while True:
+            with self._cond:
+                while self._running and self._buff is None:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                buff = self._buff
+                self._buff = None
+            try:
+                frame = self.decode(buff)
+            except Exception as e:
+                self._fail(e)
+                return
+            with self._cond:
+                self._frame = frame
+                self._frame_id += 1
+
+    def _fail(self, error):
+        with self._cond:
+            self._error = error
+            self._running = False
+            self._cond.notify_all()
@@ -0,0 +1,152 @@
+import re
+import subprocess
+import traceback
+from threading import Thread, Condition
+from time import time
+
+
+class PrinterException(Exception):
+    """Custom exception class to handle printer class errors"""
+    def __init__(self, message):
+        self.message = message
+
+
+class Printer_CUPS:
+    """Printer class submitting jobs with the local CUPS tools"""
+
+    def __init__(self, printer=None, options=["fit-to-page"]):
+        self.printer = printer
+        self.options = options
+
+    def call_cups(self, cmd):
+        try:
+            return subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            raise PrinterException("'" + ' '.join(cmd) + "' failed: " + e.output)
+        except OSError as e:
+            raise PrinterException("'" + cmd[0] + "' not found: " + str(e))
+
+    def submit(self, filename):
+        """Submits a file and returns the job id"""
+        cmd = ["lp"]
+        if self.printer:
+            cmd += ["-d", self.printer]
+        for option in self.options:
+            cmd += ["-o", option]
+        output = self.call_cups(cmd + [filename])
+        # Output looks like "request id is Printer-42 (1 file(s))"
+        match = re.search(r"request id is (\S+)", output)
+        if not match:
+            raise PrinterException("Unexpected output of lp: " + output)
+        return match.group(1)
+
+    def pending_jobs(self):
+        """Returns the ids of all jobs that are not completed yet"""
+        cmd = ["lpstat", "-o"]
+        if self.printer:
+            cmd += [self.printer]
+        output = self.call_cups(cmd)
+        return set(line.split()[0] for line in output.splitlines() if line.strip())
+
+
+class Printer_Fake:
+    """Printer class that only pretends to print, e.g., for benchmarks
+
+    Each job takes print_time seconds and submitting fails for filenames
+    listed in fail_on. The printer name is ignored.
+    """
+
+    def __init__(self, printer=None, print_time=0, fail_on=[]):
+        self.print_time = print_time
+        self.fail_on    = fail_on
+        self.jobs       = {}
+        self.printed    = []
+
+    def submit(self, filename):
+        if filename in self.fail_on:
+            raise PrinterException("Fake printer failed on " + filename)
+        job_id = "fake-" + str(len(self.jobs) + 1)
+        self.jobs[job_id] = time() + self.print_time
+        self.printed.append(filename)
+        return job_id
+
+    def pending_jobs(self):
+        now = time()
+        return set(job_id for job_id, done in self.jobs.items() if done > now)
+
+
+class PrintQueue:
+    """Spools files to a printer in a background thread.
+
+    At most max_jobs files are outstanding, i.e., waiting to be submitted
+    or submitted but not completed. While jobs are outstanding, the
+    printer is polled for their state every poll_time seconds.
+    """
+
+    def __init__(self, printer, max_jobs=3, poll_time=5):
+        self.printer   = printer
+        self.max_jobs  = max_jobs
+        self.poll_time = poll_time
+        self.failed    = 0
+
+        self._cond       = Condition()
+        self._waiting    = []
+        self._submitting = 0
+        self._active     = set()
+
+        self._thread = Thread(target=self._run, name='print-queue')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def depth(self):
+        """Returns the number of outstanding jobs"""
+        with self._cond:
+            return self._depth()
+
+    def _depth(self):
+        return len(self._waiting) + self._submitting + len(self._active)
+
+    def is_full(self):
+        return self.depth() >= self.max_jobs
+
+    def submit(self, filename):
+        """Queues a file for printing and returns the resulting queue depth.
+
+        Raises a PrinterException if too many jobs are outstanding.
+        """
+        with self._cond:
+            depth = self._depth()
+            if depth >= self.max_jobs:
+                raise PrinterException("Too many print jobs")
+            self._waiting.append(filename)
+            self._cond.notify()
+            return depth + 1
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._waiting:
+                    self._cond.wait(self.poll_time if self._active else None)
+                waiting = self._waiting
+                self._waiting = []
+                self._submitting = len(waiting)
+                active = set(self._active)
+
+            # Talk to the printer without holding the lock
+            for filename in waiting:
+                try:
+                    active.add(self.printer.submit(filename))
+                except PrinterException as e:
+                    self.failed += 1
+                    print('Error: Printing ' + filename + ' failed (' + e.message + ')')
+            if active:
+                try:
+                    active &= self.printer.pending_jobs()
+                except PrinterException as e:
+                    print('Warning: Polling the printer failed (' + e.message + ')')
+                except Exception:
+                    traceback.print_exc()
+
+            with self._cond:
+                self._submitting = 0
+                self._active = active
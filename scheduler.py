@@ -0,0 +1,45 @@
+import heapq
+from itertools import count
+from time import time
+
+
+class Scheduler:
+    """Runs timers on the main thread while waiting for GUI events.
+
+    Between two timers, it blocks in the event queue of the GUI (which
+    also receives GPIO and Bluetooth triggers), so waiting costs no CPU.
+    """
+
+    def __init__(self, display):
+        self.display = display
+        self._timers = []
+        self._ids    = count()
+
+    def call_later(self, delay, function, *args):
+        """Runs function(*args) after delay seconds, returns a handle"""
+        timer = [ time() + delay, next(self._ids), function, args ]
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def cancel(self, timer):
+        # Cancelled timers stay in the heap but do nothing
+        timer[2] = None
+
+    def clear(self):
+        self._timers = []
+
+    def wait(self):
+        """Runs all due timers and waits for the next event or timer.
+
+        Returns (r, e) like GUI_PyGame.check_for_event.
+        """
+        while self._timers and self._timers[0][0] <= time():
+            due, timer_id, function, args = heapq.heappop(self._timers)
+            if function:
+                function(*args)
+
+        if self._timers:
+            timeout = max(0, self._timers[0][0] - time())
+        else:
+            timeout = None
+        return self.display.check_for_event(timeout)
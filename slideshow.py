@@ -1,12 +1,17 @@
 #!/usr/bin/env python
 # Created by br@re-web.eu, 2015
 
-from gui import GUI_PyGame as GuiModule
+from gui import GUI_PyGame as GuiModule, GuiException, SurfaceCache
+from imaging import open_draft
+from metrics import metrics
+from watcher import DirectoryWatcher, scan
+from worker import Worker
 
-import os
+import pygame
 from datetime import datetime
 import subprocess
 import thread
+from threading import Lock
 from time import sleep
 
 #####################
@@ -29,12 +34,28 @@ display_time = 3
 # Waiting time (in seconds) between synchronizations
 sync_time = 60
 
+# Number of upcoming pictures to decode ahead
+prefetch_count = 3
+
+# Memory limit (in MB) for decoded pictures
+cache_size = 64
+
 ###############
 ### Classes ###
 ###############
 
 class Slideshow:
-    def __init__(self, display_size, display_time, directory, recursive=True):
+    """Shows the pictures of a directory one after another.
+
+    The directory is scanned once (or the pictures are given, e.g., from a
+    PictureList), afterwards new pictures are reported by a
+    DirectoryWatcher and shown next. The next pictures are decoded and
+    scaled to display size by a background worker and kept in an LRU
+    cache, so showing a picture only needs a blit.
+    """
+
+    def __init__(self, display_size, display_time, directory, recursive=True,
+                 prefetch=prefetch_count, cache_mb=cache_size, filelist=None):
         self.directory    = directory
         self.recursive    = recursive
         self.filelist     = []
@@ -42,23 +63,41 @@ class Slideshow:
         self.display_time = display_time
         self.next         = 0
 
-    def scan(self):
-        filelist = []
-
-        if self.recursive:
-            # Recursively walk all entries in the directory
-            for root, dirnames, filenames in os.walk(self.directory, followlinks=True):
-                for filename in filenames:
-                    filelist.append(os.path.join(root, filename))
+        self.prefetch_count = prefetch
+        self.cache        = SurfaceCache(cache_mb * 1024 * 1024)
+        self.decoder      = Worker('slideshow')
+        self.decoding     = {}
+
+        # Pictures added while the slideshow is running
+        self.lock         = Lock()
+        self.known        = set()
+        self.fresh        = 0
+        self.scan(filelist)
+        self.watcher      = DirectoryWatcher(directory, self.add_picture, recursive)
+        self.watcher.start(self.known)
+
+    def scan(self, filelist=None):
+        """Builds the list of pictures from scratch, the directory is only
+        scanned if no list is given
+        """
+        if filelist is None:
+            filelist = scan(self.directory, self.recursive)
         else:
-            # Add all entries in the directory
-            for item in os.listdir(self.directory):
-                filename = os.path.join(self.directory, item)
-                if os.path.isfile(filename):
-                    filelist.append(filename)
-
-        self.filelist = filelist
-        self.next = 0
+            filelist = list(filelist)
+        with self.lock:
+            self.filelist = filelist
+            self.known = set(filelist)
+            self.next = 0
+
+    def add_picture(self, filename):
+        """Inserts a new picture to be shown next (watcher thread)"""
+        with self.lock:
+            if filename in self.known:
+                return
+            self.known.add(filename)
+            # Keep the order of pictures added at once
+            self.filelist.insert(self.next + self.fresh, filename)
+            self.fresh += 1
 
     def handle_event(self, event):
         if event.type == 0:
@@ -71,32 +110,98 @@ class Slideshow:
         if key == ord('q'):
             self.teardown()
 
-    def display_next(self, text="", text2=""):
-        if self.next >= len(self.filelist):
-            self.scan()
-        if not self.filelist:
+    def display_next(self, text="", text2="", screen=None):
+        filename, surface = self._next_picture()
+        if not filename:
             self.display.clear()
+            if screen:
+                self.display.show_screen(screen)
             if text:
                 self.display.show_message(text)
             if text2:
                 self.display.show_message(text2,color=(255,0,0))
-            else:
+            elif not screen:
                 self.display.show_message("No pictures available!")
             self.display.apply()
         else:
-            filename = self.filelist[self.next]
-            self.next += 1
-            self.display.clear()
-            self.display.show_picture(filename)
-            if text:
-                self.display.show_message(text)
-            if text2:
-                self.display.show_message(text2,color=(255,0,0))
-            self.display.apply()
+            with metrics.timer('slideshow_display'):
+                self.display.clear()
+                self.display.show_picture(filename, image=surface)
+                if screen:
+                    self.display.show_screen(screen)
+                if text:
+                    self.display.show_message(text)
+                if text2:
+                    self.display.show_message(text2,color=(255,0,0))
+                self.display.apply()
+
+    def _next_picture(self):
+        """Returns (filename, surface) of the next picture that can be
+        decoded, or (None, None) if there is none.
+
+        Pictures that can't be decoded are removed, each one is tried at
+        most once per call.
+        """
+        with self.lock:
+            self.fresh = 0
+            attempts = len(self.filelist)
+        for i in range(attempts):
+            with self.lock:
+                if not self.filelist:
+                    break
+                # Start over at the end of the list
+                if self.next >= len(self.filelist):
+                    self.next = 0
+                filename = self.filelist[self.next]
+                self.next += 1
+            try:
+                with metrics.timer('slideshow_load'):
+                    return filename, self.get_picture(filename)
+            except GuiException as e:
+                print("Warning: Removing picture from slideshow (" + str(e) + ")")
+                with self.lock:
+                    if filename in self.filelist:
+                        index = self.filelist.index(filename)
+                        del self.filelist[index]
+                        if index < self.next:
+                            self.next -= 1
+        return None, None
+
+    def decode(self, filename):
+        """Returns the picture scaled to display size (decoder worker)"""
+        size = self.display.get_size()
+        try:
+            surface = self.display.fit_image(open_draft(filename, size), size)
+        except (IOError, pygame.error) as e:
+            raise GuiException("Can't open image '" + filename + "': " + str(e))
+        self.cache.put(filename, surface)
+        return surface
+
+    def get_picture(self, filename):
+        """Returns the decoded picture, waiting for it if necessary"""
+        surface = self.cache.get(filename)
+        if surface is None:
+            job = self.decoding.pop(filename, None)
+            if job is None:
+                job = self.decoder.submit(self.decode, filename)
+            surface = job.result()
+        return surface
+
+    def prefetch(self):
+        """Queues the upcoming pictures for decoding"""
+        for job_filename, job in list(self.decoding.items()):
+            if job.done():
+                del self.decoding[job_filename]
+        with self.lock:
+            upcoming = self.filelist[self.next:self.next + self.prefetch_count]
+        for filename in upcoming:
+            if filename not in self.cache and filename not in self.decoding:
+                self.decoding[filename] = self.decoder.submit(self.decode, filename)
 
     def run(self):
         while True:
             self.display_next()
+            self.prefetch()
             sleep(self.display_time)
             r, e = self.display.check_for_event()
             if r:
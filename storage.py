@@ -0,0 +1,137 @@
+import os
+import traceback
+from threading import Thread
+from Queue import Queue, Empty
+import cStringIO as StringIO
+
+from metrics import metrics
+from worker import Job
+
+
+def atomic_write(filename, data):
+    """Writes data to filename such that a crash leaves either the old or
+    the new content, never a truncated file.
+    """
+    tmp_filename = _write_temp(filename, data)
+    os.rename(tmp_filename, filename)
+    # Make the rename itself durable
+    _sync_directory(os.path.dirname(filename) or '.')
+
+def _temp_name(filename):
+    # Hidden, so the slideshow never picks up a partially written file
+    dirname = os.path.dirname(filename) or '.'
+    return os.path.join(dirname, '.' + os.path.basename(filename) + '.tmp')
+
+def _write_temp(filename, data):
+    tmp_filename = _temp_name(filename)
+    with open(tmp_filename, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    return tmp_filename
+
+def _sync_directory(dirname):
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Storage:
+    """Writes files in a background thread, safe against power cuts.
+
+    Every file is written to a hidden temporary file, synced and renamed,
+    so readers (slideshow, printer) only ever see complete files. Writes
+    that queue up while the card is busy are committed as a batch, with
+    one sync per directory instead of one per file. At most max_pending
+    writes are queued, beyond that submitting blocks until the card has
+    caught up.
+
+    Each write returns a Job that completes with the filename once the
+    file is committed, callbacks are run (by the storage thread) after
+    that, e.g., to add the file to a PictureList.
+    """
+
+    def __init__(self, max_pending=8, batch_size=8):
+        self.batch_size = batch_size
+        self.failed     = 0
+        self._queue     = Queue(max_pending)
+        self._thread = Thread(target=self._run, name='storage')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, filename, data, callback=None):
+        """Queues data to be written to filename and returns its Job"""
+        return self._submit(filename, lambda: data, callback)
+
+    def save_image(self, image, filename, format="JPEG", callback=None):
+        """Queues a PIL image to be encoded and written to filename.
+
+        The image must not be modified until the returned Job is done.
+        """
+        def encode():
+            with metrics.timer('encode'):
+                buff = StringIO.StringIO()
+                image.save(buff, format)
+                return buff.getvalue()
+        return self._submit(filename, encode, callback)
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def flush(self):
+        """Waits until all writes queued so far are committed"""
+        self._submit(None, None, None).wait()
+
+    def _submit(self, filename, encode, callback):
+        job = Job(None)
+        self._queue.put((job, filename, encode, callback))
+        return job
+
+    def _run(self):
+        while True:
+            # Take whatever has queued up meanwhile as one batch
+            batch = [ self._queue.get() ]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            self._commit(batch)
+
+    def _commit(self, batch):
+        written = []
+        for job, filename, encode, callback in batch:
+            if filename is None:
+                written.append((job, filename, callback))
+                continue
+            try:
+                data = encode()
+                with metrics.timer('write'):
+                    tmp_filename = _write_temp(filename, data)
+                    os.rename(tmp_filename, filename)
+                written.append((job, filename, callback))
+            except Exception as e:
+                self.failed += 1
+                metrics.count('write_errors')
+                print('Error: Writing ' + filename + ' failed (' + str(e) + ')')
+                job.finish(error=e)
+
+        # Make all renames durable before anyone gets to see the files
+        directories = set(os.path.dirname(filename) or '.'
+                          for job, filename, callback in written if filename)
+        for dirname in directories:
+            try:
+                with metrics.timer('sync'):
+                    _sync_directory(dirname)
+            except OSError as e:
+                print('Warning: Syncing ' + dirname + ' failed (' + str(e) + ')')
+
+        for job, filename, callback in written:
+            if callback is not None:
+                try:
+                    callback(filename)
+                except Exception:
+                    traceback.print_exc()
+            job.finish(filename)
@@ -0,0 +1,128 @@
+import os
+from threading import Thread
+from time import sleep
+
+inotify_enabled = False
+
+try:
+    import pyinotify
+    inotify_enabled = True
+except ImportError:
+    pass
+
+# File types shown in the slideshow
+image_extensions = ('.jpg', '.jpeg', '.png')
+
+def is_image(filename):
+    """Checks the file type, skipping hidden (e.g., temporary) files"""
+    name = os.path.basename(filename)
+    return not name.startswith('.') and name.lower().endswith(image_extensions)
+
+def scan(directory, recursive=True):
+    """Returns all images in the directory in a stable (sorted) order"""
+    filelist = []
+    if recursive:
+        # Recursively walk all entries in the directory
+        for root, dirnames, filenames in os.walk(directory, followlinks=True):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if is_image(filename):
+                    filelist.append(os.path.join(root, filename))
+    elif os.path.isdir(directory):
+        # Add all entries in the directory
+        for item in sorted(os.listdir(directory)):
+            filename = os.path.join(directory, item)
+            if os.path.isfile(filename) and is_image(filename):
+                filelist.append(filename)
+    return filelist
+
+
+class DirectoryWatcher:
+    """Reports images that are added to a directory (tree).
+
+    Files are only reported once they are completely written. This uses
+    inotify if pyinotify is available. Otherwise, directories are polled
+    every poll_time seconds, listing only those whose modification time
+    changed and reporting files once their size stopped changing.
+    """
+
+    def __init__(self, directory, callback, recursive=True, poll_time=2):
+        self.directory = directory
+        self.callback  = callback
+        self.recursive = recursive
+        self.poll_time = poll_time
+
+    def start(self, known=()):
+        """Starts watching, files in known are not reported"""
+        if inotify_enabled:
+            self._start_inotify()
+        else:
+            thread = Thread(target=self._poll, args=(set(known),), name='watcher')
+            thread.daemon = True
+            thread.start()
+
+    def _start_inotify(self):
+        callback = self.callback
+
+        class Handler(pyinotify.ProcessEvent):
+            def process_IN_CLOSE_WRITE(self, event):
+                if is_image(event.pathname):
+                    callback(event.pathname)
+            process_IN_MOVED_TO = process_IN_CLOSE_WRITE
+
+        manager = pyinotify.WatchManager()
+        self._notifier = pyinotify.ThreadedNotifier(manager, Handler())
+        self._notifier.daemon = True
+        self._notifier.start()
+        mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO | pyinotify.IN_CREATE
+        manager.add_watch(self.directory, mask, rec=self.recursive,
+                          auto_add=self.recursive)
+
+    def _poll(self, known):
+        # Modification times of all watched directories, the files in
+        # there at this point are expected to be known already
+        directories = { self.directory: None }
+        if self.recursive:
+            for root, dirnames, filenames in os.walk(self.directory, followlinks=True):
+                for dirname in dirnames:
+                    directories[os.path.join(root, dirname)] = None
+        for directory in directories:
+            try:
+                directories[directory] = os.stat(directory).st_mtime
+            except OSError:
+                pass
+        # Sizes of new files that may still be written
+        pending = {}
+
+        while True:
+            for directory, mtime in list(directories.items()):
+                try:
+                    new_mtime = os.stat(directory).st_mtime
+                    if new_mtime == mtime:
+                        continue
+                    directories[directory] = new_mtime
+                    entries = os.listdir(directory)
+                except OSError:
+                    continue
+                for entry in entries:
+                    path = os.path.join(directory, entry)
+                    if os.path.isdir(path):
+                        if self.recursive and path not in directories:
+                            directories[path] = None
+                    elif path not in known and is_image(path):
+                        pending.setdefault(path, -1)
+
+            for path, size in list(pending.items()):
+                try:
+                    new_size = os.path.getsize(path)
+                except OSError:
+                    del pending[path]
+                    continue
+                if new_size == size and size > 0:
+                    del pending[path]
+                    known.add(path)
+                    self.callback(path)
+                else:
+                    pending[path] = new_size
+
+            sleep(self.poll_time)
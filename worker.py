@@ -0,0 +1,114 @@
+import os
+from threading import Thread, Event
+from Queue import Queue, Full
+
+
+class WorkerException(Exception):
+    """Custom exception class to handle worker errors"""
+
+
+class Job:
+    """Handle for a function executed by a Worker.
+
+    It is completed exactly once, either with the return value of the
+    function or with the exception it raised.
+    """
+
+    def __init__(self, function, args=(), kwargs={}):
+        self.function  = function
+        self.args      = args
+        self.kwargs    = kwargs
+        self.cancelled = False
+        self._done     = Event()
+        self._result   = None
+        self._error    = None
+
+    def run(self):
+        if not self.cancelled:
+            try:
+                self._result = self.function(*self.args, **self.kwargs)
+            except Exception as e:
+                self._error = e
+        self._done.set()
+
+    def finish(self, result=None, error=None):
+        """Complete the job without running it, e.g., by a batch"""
+        self._result = result
+        self._error  = error
+        self._done.set()
+
+    def cancel(self):
+        """Skip the job if it has not been started yet"""
+        self.cancelled = True
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Block until the job has finished and return its result.
+
+        Exceptions raised by the function are re-raised here.
+        """
+        if not self.wait(timeout):
+            raise WorkerException("Job did not finish in time")
+        if self._error is not None:
+            raise self._error
+        if self.cancelled and self._result is None:
+            raise WorkerException("Job was cancelled")
+        return self._result
+
+
+class Worker:
+    """A background thread executing jobs in the order they are submitted.
+
+    With several threads, jobs are started in order but run concurrently.
+    A positive nice value lowers the priority of the threads, e.g., for
+    work that must never slow down the booth.
+    """
+
+    def __init__(self, name, maxsize=0, threads=1, nice=0):
+        self.name   = name
+        self.nice   = nice
+        self._queue = Queue(maxsize)
+        self._threads = [ Thread(target=self._run, name=name) for i in range(threads) ]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, function, *args, **kwargs):
+        """Queue a function call and return its Job.
+
+        Blocks while a bounded queue is full.
+        """
+        job = Job(function, args, kwargs)
+        self._queue.put(job)
+        return job
+
+    def try_submit(self, function, *args, **kwargs):
+        """Queue a function call and return its Job, or None if the
+        (bounded) queue is full.
+        """
+        job = Job(function, args, kwargs)
+        try:
+            self._queue.put_nowait(job)
+        except Full:
+            return None
+        return job
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        if self.nice:
+            # On Linux, this only affects the calling thread
+            try:
+                os.nice(self.nice)
+            except OSError as e:
+                print('Warning: Lowering the priority of ' + self.name + ' failed (' + str(e) + ')')
+        while True:
+            job = self._queue.get()
+            job.run()